@@ -7,6 +7,9 @@ Copyright: Johannes Buchner (C) 2013-2025
 """
 
 import os
+import hashlib
+from collections import OrderedDict
+import numpy
 
 if 'MAKESPHINXDOC' not in os.environ:
 	from sherpa.models import ArithmeticModel, CompositeModel
@@ -18,24 +21,74 @@ else:
 
 
 class VariableCachedModel(CompositeModel, ArithmeticModel):
-	"""Wrapper that caches the most recent model call."""
-	def __init__(self, othermodel):
-		"""*othermodel* can be any sherpa model"""
+	"""Wrapper that caches recent model calls.
+
+	Results are stored by a hash of the parameter values and the
+	energy grid. When the cache is full, the least recently
+	used result is removed.
+
+	:param othermodel: any sherpa model
+	:param maxsize: maximum number of results stored
+	:param maxbytes: maximum total size of the stored results, in bytes (None: no limit)
+	"""
+	def __init__(self, othermodel, maxsize=16, maxbytes=None):
 		self.othermodel = othermodel
-		self.cache = None
-		self.lastp = None
-		print('calling CompositeModel...')
 		CompositeModel.__init__(self, name='cached(%s)' % othermodel.name, parts=(othermodel,))
-	
-	def calc(self, p, left, right, *args, **kwargs):
-		if self.cache is None or self.lastp != p:
-			self.cache = self.othermodel.calc(p, left, right, *args, **kwargs)
-			self.lastp = p
-		return self.cache
-
-	def startup(self):
-		self.othermodel.startup()
-		CompositeModel.startup(self)
+		self.maxsize = maxsize
+		self.maxbytes = maxbytes
+		self.results = OrderedDict()
+		self.nbytes = 0
+		self.hits = 0
+		self.misses = 0
+
+	@staticmethod
+	def cache_key(p, left, *args):
+		"""Hash of the parameter values and the grid arguments."""
+		h = hashlib.sha1(numpy.ascontiguousarray(p, dtype=float).tobytes())
+		for a in (left,) + args:
+			h.update(b'|')
+			h.update(numpy.ascontiguousarray(a).tobytes())
+		return h.digest()
+
+	def calc(self, p, left, *args, **kwargs):
+		key = self.cache_key(p, left, *args)
+		result = self.results.get(key)
+		if result is not None:
+			self.hits += 1
+			self.results.move_to_end(key)
+			return result
+		self.misses += 1
+		result = self.othermodel.calc(p, left, *args, **kwargs)
+		self.store(key, result)
+		return result
+
+	def store(self, key, result):
+		"""Add *result* to the cache, removing the least recently used entries if needed."""
+		nbytes = numpy.asarray(result).nbytes
+		if self.maxbytes is not None and nbytes > self.maxbytes:
+			return
+		self.results[key] = result
+		self.nbytes += nbytes
+		while len(self.results) > self.maxsize or (self.maxbytes is not None and self.nbytes > self.maxbytes):
+			_, removed = self.results.popitem(last=False)
+			self.nbytes -= numpy.asarray(removed).nbytes
+
+	def clear_cache(self):
+		"""Remove all stored results and reset the counters."""
+		self.results.clear()
+		self.nbytes = 0
+		self.hits = 0
+		self.misses = 0
+
+	@property
+	def hit_rate(self):
+		"""Fraction of calls answered from the cache."""
+		ncalls = self.hits + self.misses
+		return self.hits / ncalls if ncalls > 0 else 0.0
+
+	def startup(self, cache=False):
+		self.othermodel.startup(cache)
+		CompositeModel.startup(self, cache)
 	
 	def teardown(self):
 		self.othermodel.teardown()
@@ -60,9 +113,9 @@ class CachedModel(CompositeModel, ArithmeticModel):
 			self.cache = self.othermodel.calc(*args, **kwargs)
 		return self.cache * self.relnorm.val
 
-	def startup(self):
-		self.othermodel.startup()
-		CompositeModel.startup(self)
+	def startup(self, cache=False):
+		self.othermodel.startup(cache)
+		CompositeModel.startup(self, cache)
 	
 	def teardown(self):
 		self.othermodel.teardown()
@@ -0,0 +1,359 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+BXA (Bayesian X-ray Analysis) for Sherpa
+
+Copyright: Johannes Buchner (C) 2013-2025
+
+Fast Cash/C-stat computation from a snapshot of the responses.
+"""
+
+import os
+import numpy
+import scipy.sparse
+import scipy.stats
+
+from .frozencache import cache_subexpressions
+
+if 'MAKESPHINXDOC' not in os.environ:
+	import sherpa.astro.ui as ui
+
+
+def rmf_to_csr(rmf):
+	"""Convert the compressed matrix of a sherpa DataRMF into a
+	scipy.sparse CSR matrix of shape (number of energies, number of channels)."""
+	n_grp = numpy.asarray(rmf.n_grp, dtype=int)
+	f_chan = numpy.asarray(rmf.f_chan, dtype=int) - int(rmf.offset)
+	n_chan = numpy.asarray(rmf.n_chan, dtype=int)
+	nelements = n_chan.sum()
+	group_row = numpy.repeat(numpy.arange(len(n_grp)), n_grp)
+	rows = numpy.repeat(group_row, n_chan)
+	cols = numpy.repeat(f_chan - (numpy.cumsum(n_chan) - n_chan), n_chan) + numpy.arange(nelements)
+	values = numpy.asarray(rmf.matrix, dtype=float)[:nelements]
+	return scipy.sparse.csr_matrix(
+		(values, (rows, cols)), shape=(len(rmf.energ_lo), int(rmf.detchans)))
+
+
+class FoldedDataset(object):
+	"""Snapshot of one PHA dataset: noticed counts and folding matrix."""
+	def __init__(self, id):
+		data = ui.get_data(id)
+		if getattr(data, 'subtracted', False):
+			raise ValueError('dataset %s: background-subtracted data are not Poisson distributed' % id)
+		if getattr(ui._session, '_background_models', {}).get(id) or getattr(ui._session, '_background_sources', {}).get(id):
+			raise ValueError('dataset %s: background models are not supported by the fast path, use the default statistic' % id)
+		areascal = getattr(data, 'areascal', None)
+		if areascal is not None and numpy.any(numpy.asarray(areascal) != 1):
+			raise ValueError('dataset %s: AREASCAL is not supported by the fast path' % id)
+
+		self.id = id
+		try:
+			self.source = ui.get_source(id)
+		except Exception:
+			raise ValueError('dataset %s: models set with set_full_model are not supported by the fast path, use the default statistic' % id)
+		rmf = data.get_rmf()
+		arf = data.get_arf()
+		self.elo = numpy.asarray(rmf.energ_lo, dtype=float)
+		self.ehi = numpy.asarray(rmf.energ_hi, dtype=float)
+		effarea = numpy.ones(len(self.elo)) * data.exposure
+		if arf is not None:
+			effarea = effarea * arf.specresp
+
+		# sum channels into the noticed (grouped) bins
+		channels = numpy.arange(int(rmf.detchans))
+		first = data.apply_filter(channels, groupfunc=numpy.min).astype(int)
+		last = data.apply_filter(channels, groupfunc=numpy.max).astype(int)
+		nchannels = last - first + 1
+		rows = numpy.repeat(numpy.arange(len(first)), nchannels)
+		cols = numpy.repeat(first - (numpy.cumsum(nchannels) - nchannels), nchannels) + numpy.arange(nchannels.sum())
+		grouping = scipy.sparse.csr_matrix(
+			(numpy.ones(len(rows)), (rows, cols)), shape=(len(first), len(channels)))
+
+		# noticed bins x energies, including effective area and exposure
+		self.response = (grouping @ rmf_to_csr(rmf).T.tocsr()).multiply(effarea.reshape((1, -1))).tocsr()
+		self.counts = numpy.asarray(data.get_dep(filter=True), dtype=float)
+		assert len(self.counts) == self.response.shape[0], (len(self.counts), self.response.shape)
+
+	def predict(self, fluxes):
+		"""Fold source photon fluxes of shape (number of energies, N) into
+		predicted counts of shape (number of noticed bins, N)."""
+		return self.response @ fluxes
+
+
+class FastFoldedStatistic(object):
+	"""
+	Poisson fit statistic computed directly in NumPy.
+
+	The noticed channels, ARF and RMF (as a sparse matrix) of each
+	dataset are read once. Each likelihood call then only evaluates the
+	source models on the response energy grid and folds them with
+	a sparse-dense matrix product for the whole batch of points.
+
+	Only datasets without background models (and without background
+	subtraction) are supported. The statistic (cash or cstat) is
+	taken from the current sherpa session, and gives the same values as
+	sherpa's calc_stat.
+
+	Usage::
+
+		stat = FastFoldedStatistic(parameters, id=id, otherids=otherids)
+		solver = BXASolver(id=id, otherids=otherids, parameters=parameters,
+			prior=prior, vectorized=True, stat_function=stat)
+
+	:param parameters: List of parameters analysed (in the order of the points passed).
+	:param id: See the sherpa documentation of calc_stat.
+	:param otherids: See the sherpa documentation of calc_stat.
+	:param trunc_value: model values below zero are replaced by this value, as in sherpa.
+	"""
+	def __init__(self, parameters, id=None, otherids=(), trunc_value=1e-25):
+		self.parameters = parameters
+		ids = ui._session._get_fit(id, otherids)[0]
+		self.datasets = [FoldedDataset(i) for i in ids]
+		statname = ui.get_stat_name().lower()
+		if statname not in ('cash', 'cstat'):
+			raise ValueError('Fit statistic must be cash or cstat, not %s' % statname)
+		self.statname = statname
+		self.trunc_value = trunc_value
+
+		# constant terms, only depend on the data
+		self.constant = 0.0
+		if statname == 'cstat':
+			for d in self.datasets:
+				k = d.counts[d.counts > 0]
+				self.constant += (k * numpy.log(k) - k).sum()
+
+		self.evaluations = self._group_evaluations(self.datasets)
+
+	@staticmethod
+	def _group_evaluations(datasets):
+		"""Datasets sharing source model and energy grid are evaluated only once."""
+		evaluations = {}
+		for d in datasets:
+			key = (id(d.source), d.elo.tobytes(), d.ehi.tobytes())
+			evaluations.setdefault(key, (d.source, d.elo, d.ehi))
+			d.evaluation_key = key
+		return evaluations
+
+	def evaluate_sources(self, points):
+		"""Evaluate all source models for each row of *points*."""
+		fluxes = {key: numpy.empty((len(elo), len(points))) for key, (source, elo, ehi) in self.evaluations.items()}
+		for j, row in enumerate(points):
+			for p, v in zip(self.parameters, row):
+				p.val = v
+			for key, (source, elo, ehi) in self.evaluations.items():
+				fluxes[key][:, j] = source(elo, ehi)
+		return fluxes
+
+	def __call__(self, points):
+		"""Return the fit statistic for each row of *points* (shape (N, ndim))."""
+		points = numpy.asarray(points, dtype=float).reshape((len(points), -1))
+		fluxes = self.evaluate_sources(points)
+		stat = numpy.zeros(len(points)) + self.constant
+		for d in self.datasets:
+			model = d.predict(fluxes[d.evaluation_key])
+			model = numpy.where(model > 0, model, self.trunc_value)
+			counts = d.counts.reshape((-1, 1))
+			stat += (model - counts * numpy.log(model)).sum(axis=0)
+		return 2 * stat
+
+
+class ProfiledAmplitudeStatistic(FastFoldedStatistic):
+	"""
+	Poisson fit statistic with amplitude parameters removed analytically.
+
+	The source models have to be linear in each amplitude (for example,
+	the normalisations of additive components). For each point, the
+	sources are evaluated with K+1 amplitude settings to obtain the
+	folded templates, and the amplitudes (constrained to be non-negative
+	and within the parameter limits, min and max) that maximise the Poisson likelihood are found with projected
+	Newton iterations.
+
+	For the template evaluations, each model component is cached by its
+	own parameter values (see cache_subexpressions). Components which do
+	not depend on an amplitude, and additive XSPEC components (stored for
+	norm=1 and rescaled), are therefore computed only once per point.
+
+	With method='profile', the fit statistic at the best amplitudes is
+	returned. With method='laplace', the amplitudes are marginalised with
+	a Laplace approximation, assuming a uniform prior between the
+	parameter limits (min and max) of each amplitude.
+
+	As for FastFoldedStatistic, only datasets with source models
+	(set_source) and without background models are supported. Background
+	normalisations, and models set with set_full_model (as in the
+	xagnfitter.py example, which models the background together with the
+	source) cannot be removed in this way; these parameters have to be
+	sampled with the default statistic.
+
+	Only the other parameters need to be sampled::
+
+		stat = ProfiledAmplitudeStatistic(parameters, [src.norm, apec.norm], id=id)
+		solver = BXASolver(id=id, parameters=parameters, stat_function=stat)
+
+	:param parameters: List of parameters analysed (in the order of the points passed).
+	:param amplitudes: List of amplitude parameters to remove.
+	:param id: See the sherpa documentation of calc_stat.
+	:param otherids: See the sherpa documentation of calc_stat.
+	:param method: 'profile' or 'laplace'.
+	:param maxiter: maximum number of Newton iterations.
+	"""
+	def __init__(self, parameters, amplitudes, id=None, otherids=(), method='profile', trunc_value=1e-25, maxiter=50):
+		if method not in ('profile', 'laplace'):
+			raise ValueError("method must be 'profile' or 'laplace', not %s" % method)
+		FastFoldedStatistic.__init__(self, parameters, id=id, otherids=otherids, trunc_value=trunc_value)
+		self.amplitudes = list(amplitudes)
+		self.method = method
+		self.maxiter = maxiter
+		self.counts = numpy.concatenate([d.counts for d in self.datasets])
+		# allowed range of the amplitudes
+		self.lower = numpy.array([max(p.min, 0) for p in self.amplitudes], dtype=float)
+		self.upper = numpy.array([p.max for p in self.amplitudes], dtype=float)
+		# source expressions with cached components, for the K+1 template evaluations
+		memo = {}
+		self.template_sources = {
+			key: cache_subexpressions(source, maxsize=len(self.amplitudes) + 2, memo=memo, components=True)
+			for key, (source, elo, ehi) in self.evaluations.items()}
+		# log of the uniform prior density of the amplitudes
+		self.log_prior = -numpy.log(self.upper - self.lower).sum()
+
+	def _settings(self):
+		"""Two values per amplitude, within the parameter limits, to extract the templates."""
+		settings = []
+		for p, lo in zip(self.amplitudes, self.lower):
+			v1 = p.val
+			if 0 < v1 and v1 * 2 <= p.max:
+				v2 = v1 * 2
+			elif v1 < p.max:
+				v2 = (v1 + p.max) / 2
+			elif v1 > lo:
+				# at the upper limit
+				v2 = (v1 + lo) / 2
+			else:
+				raise ValueError('amplitude %s cannot be varied (value %s, limits %s..%s)' % (p.fullname, v1, p.min, p.max))
+			settings.append((v1, v2))
+		return settings
+
+	def templates(self, row):
+		"""Folded count templates for parameter values *row*.
+
+		Returns the counts without amplitude contributions (shape (nbins,))
+		and the counts per unit amplitude (shape (nbins, K)).
+		"""
+		for p, v in zip(self.parameters, row):
+			p.val = v
+		settings = self._settings()
+		K = len(self.amplitudes)
+		predictions = []
+		for k in range(K + 1):
+			# k=0: all amplitudes at their first value; k>0: amplitude k-1 changed
+			for j, (p, (v1, v2)) in enumerate(zip(self.amplitudes, settings)):
+				p.val = v2 if j == k - 1 else v1
+			fluxes = {key: self.template_sources[key](elo, ehi) for key, (source, elo, ehi) in self.evaluations.items()}
+			predictions.append(numpy.concatenate([d.predict(fluxes[d.evaluation_key]) for d in self.datasets]))
+		for p, (v1, v2) in zip(self.amplitudes, settings):
+			p.val = v1
+		base = predictions[0]
+		v1 = numpy.array([v1 for v1, v2 in settings])
+		v2 = numpy.array([v2 for v1, v2 in settings])
+		unit = (numpy.transpose(predictions[1:]) - base.reshape((-1, 1))) / (v2 - v1)
+		offset = base - unit @ v1
+		# remove round-off from the subtraction
+		offset[numpy.abs(offset) < 1e-10 * numpy.abs(base)] = 0
+		return offset, unit
+
+	def maximize(self, offset, unit):
+		"""Amplitudes within their limits maximising the Poisson likelihood.
+
+		Returns the amplitudes, the log-likelihood (without data-only terms)
+		and the Hessian matrix of the negative log-likelihood."""
+		d = self.counts
+		K = unit.shape[1]
+		# start from amplitudes matching the total counts
+		excess = max(d.sum() - offset.sum(), 1.0)
+		a = excess / K / numpy.maximum(unit.sum(axis=0), self.trunc_value)
+		a = numpy.clip(a, self.lower, self.upper)
+
+		def loglike(a):
+			m = numpy.maximum(offset + unit @ a, self.trunc_value)
+			return (d * numpy.log(m) - m).sum(), m
+
+		logl, m = loglike(a)
+		for _ in range(self.maxiter):
+			gradient = unit.T @ (d / m - 1)
+			hessian = (unit.T * (d / m**2)) @ unit
+			# amplitudes at a limit which would move beyond it are kept fixed
+			free = ((a > self.lower) | (gradient > 0)) & ((a < self.upper) | (gradient < 0))
+			step = numpy.zeros(K)
+			if free.any():
+				h = hessian[numpy.ix_(free, free)] + 1e-12 * numpy.eye(free.sum())
+				step[free] = numpy.linalg.solve(h, gradient[free])
+			for _ in range(30):
+				a_new = numpy.clip(a + step, self.lower, self.upper)
+				logl_new, m_new = loglike(a_new)
+				if logl_new >= logl:
+					break
+				step /= 2
+			else:
+				break
+			converged = logl_new - logl < 1e-8
+			a, logl, m = a_new, logl_new, m_new
+			if converged:
+				break
+		hessian = (unit.T * (d / m**2)) @ unit
+		return a, logl, hessian
+
+	def fit_amplitudes(self, points):
+		"""Best amplitudes for each row of *points*."""
+		points = numpy.asarray(points, dtype=float).reshape((len(points), -1))
+		return numpy.array([self.maximize(*self.templates(row))[0] for row in points])
+
+	def laplace_logvolume(self, hessian):
+		"""Logarithm of the volume of the Gaussian approximation to the likelihood,
+		(2 pi)^(K/2) / sqrt(det(hessian))."""
+		sign, logdet = numpy.linalg.slogdet(hessian)
+		if sign <= 0:
+			return -numpy.inf
+		return len(self.amplitudes) / 2 * numpy.log(2 * numpy.pi) - logdet / 2
+
+	def sample_amplitudes(self, points, rng=None, nsweeps=10):
+		"""Draw amplitudes for each row of *points*.
+
+		The amplitudes are drawn from the Laplace approximation, a Gaussian
+		centred at the best amplitudes with the inverse Hessian as covariance,
+		truncated to the parameter limits (with Gibbs sampling).
+
+		Returns the amplitudes (shape (N, K)) and the log-volume term of
+		the Laplace approximation (see laplace_logvolume) for each row.
+		"""
+		if rng is None:
+			rng = numpy.random.default_rng()
+		points = numpy.asarray(points, dtype=float).reshape((len(points), -1))
+		K = len(self.amplitudes)
+		amplitudes = numpy.empty((len(points), K))
+		logvolumes = numpy.empty(len(points))
+		for j, row in enumerate(points):
+			best, logl, hessian = self.maximize(*self.templates(row))
+			logvolumes[j] = self.laplace_logvolume(hessian)
+			precision = hessian + 1e-12 * numpy.eye(K)
+			a = best.copy()
+			for _ in range(nsweeps):
+				for k in range(K):
+					# conditional distribution of amplitude k given the others
+					sigma = precision[k,k]**-0.5
+					mean = best[k] - (precision[k] @ (a - best) - precision[k,k] * (a[k] - best[k])) / precision[k,k]
+					a[k] = scipy.stats.truncnorm.rvs(
+						(self.lower[k] - mean) / sigma, (self.upper[k] - mean) / sigma,
+						loc=mean, scale=sigma, random_state=rng)
+			amplitudes[j] = a
+		return amplitudes, logvolumes
+
+	def __call__(self, points):
+		"""Return the fit statistic for each row of *points* (shape (N, ndim))."""
+		points = numpy.asarray(points, dtype=float).reshape((len(points), -1))
+		stat = numpy.empty(len(points))
+		for j, row in enumerate(points):
+			a, logl, hessian = self.maximize(*self.templates(row))
+			if self.method == 'laplace':
+				logl += self.laplace_logvolume(hessian) + self.log_prior
+			stat[j] = 2 * (self.constant - logl)
+		return stat
@@ -0,0 +1,231 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+BXA (Bayesian X-ray Analysis) for Sherpa
+
+Copyright: Johannes Buchner (C) 2013-2025
+
+Flux posterior computation, in chunks and optionally in parallel.
+"""
+
+import os
+import multiprocessing
+import numpy
+from tqdm import tqdm
+
+if 'MAKESPHINXDOC' not in os.environ:
+	import sherpa.astro.ui as ui
+
+
+def calc_fluxes(parameters, rows, id=None, elo=None, ehi=None):
+	"""Compute photon and energy flux for each row of parameter values.
+
+	Returns an array with the rows and two additional columns:
+	the photon fluxes and the energy fluxes.
+	"""
+	r = numpy.empty((len(rows), len(parameters) + 2))
+	for j, row in enumerate(rows):
+		for p, v in zip(parameters, row):
+			p.val = v
+		r[j,:-2] = row
+		r[j,-2] = ui._session.calc_photon_flux(lo=elo, hi=ehi, id=id)
+		r[j,-1] = ui._session.calc_energy_flux(lo=elo, hi=ehi, id=id)
+	return r
+
+
+def find_parameters(fullnames):
+	"""Look up parameters of the current session by their full name.
+
+	Parameters not attached to a model component (for example
+	ancillary parameters linked into a model) are found through the links.
+	"""
+	found = {}
+	def visit(par):
+		found.setdefault(par.fullname, par)
+		for part in getattr(par, 'parts', ()):
+			visit(part)
+		link = getattr(par, 'link', None)
+		if link is not None:
+			visit(link)
+
+	for name in ui.list_model_components():
+		for par in ui.get_model_component(name).pars:
+			visit(par)
+	return [found[name] for name in fullnames]
+
+
+def _restore_session(filename):
+	"""Pool initializer: load the session state of the parent process."""
+	ui.restore(filename)
+
+
+def _calc_fluxes_task(args):
+	fullnames, rows, id, elo, ehi = args
+	return calc_fluxes(find_parameters(fullnames), rows, id=id, elo=elo, ehi=ehi)
+
+
+def get_distribution_with_fluxes(
+	parameters, samples, id=None, elo=None, ehi=None,
+	nprocesses=1, chunksize=1000, checkpoint_dir=None
+):
+	"""Computes flux posterior samples in chunks.
+
+	:param parameters: list of parameters, matching the columns of *samples*
+	:param samples: equally weighted posterior samples
+	:param id: dataset to compute fluxes for
+	:param elo: lower end of the energy band
+	:param ehi: upper end of the energy band
+	:param nprocesses: number of worker processes. Each worker restores
+		a copy of the sherpa session (data, responses, models).
+	:param chunksize: number of samples per chunk.
+	:param checkpoint_dir: if set, finished chunks are stored in this directory,
+		and reused if the function is called again with the same samples.
+
+	Returns an array of the samples with two additional columns:
+	the photon fluxes and the energy fluxes.
+	"""
+	samples = numpy.asarray(samples)
+	chunks = [samples[i:i + chunksize] for i in range(0, len(samples), chunksize)]
+	results = [None] * len(chunks)
+	if checkpoint_dir is not None:
+		os.makedirs(checkpoint_dir, exist_ok=True)
+		for k, rows in enumerate(chunks):
+			filename = os.path.join(checkpoint_dir, 'chunk%05d.npy' % k)
+			if os.path.exists(filename):
+				r = numpy.load(filename)
+				# only reuse if the chunk was computed from the same samples
+				if r.shape[0] == len(rows) and numpy.array_equal(r[:,:-2], rows):
+					results[k] = r
+	todo = [k for k, r in enumerate(results) if r is None]
+
+	def store(k, r):
+		results[k] = r
+		if checkpoint_dir is not None:
+			numpy.save(os.path.join(checkpoint_dir, 'chunk%05d.npy' % k), r)
+
+	with tqdm(total=len(samples), initial=len(samples) - sum(len(chunks[k]) for k in todo), disable=None) as pbar:
+		if nprocesses > 1 and len(todo) > 1:
+			import tempfile
+			with tempfile.TemporaryDirectory() as tmpdir:
+				session_file = os.path.join(tmpdir, 'session.save')
+				ui.save(session_file, clobber=True)
+				fullnames = [p.fullname for p in parameters]
+				with multiprocessing.Pool(nprocesses, initializer=_restore_session, initargs=(session_file,)) as pool:
+					tasks = [(fullnames, chunks[k], id, elo, ehi) for k in todo]
+					for k, r in zip(todo, pool.imap(_calc_fluxes_task, tasks)):
+						store(k, r)
+						pbar.update(len(r))
+		else:
+			for k in todo:
+				r = calc_fluxes(parameters, chunks[k], id=id, elo=elo, ehi=ehi)
+				store(k, r)
+				pbar.update(len(r))
+
+	if len(results) == 0:
+		return numpy.empty((0, len(parameters) + 2))
+	return numpy.vstack(results)
+
+
+keV_to_erg = 1.602176634e-9
+
+
+def create_flux_grid(bands, zmin=0, zmax=0, restframe_bands=(), nbins=2000):
+	"""Energy grid covering all bands, for a single model evaluation.
+
+	The grid is logarithmically spaced and contains the band edges
+	of the observed-frame bands exactly. Rest-frame bands are covered
+	for redshifts between *zmin* and *zmax*.
+	"""
+	edges = [e for band in bands for e in band]
+	emin = min(edges + [lo / (1 + zmax) for lo, hi in restframe_bands])
+	emax = max(edges + [hi / (1 + zmin) for lo, hi in restframe_bands])
+	grid = numpy.logspace(numpy.log10(emin), numpy.log10(emax), nbins + 1)
+	return numpy.unique(numpy.concatenate((grid, edges)))
+
+
+class LuminosityDistance(object):
+	"""Tabulated luminosity distance (in cm) for fast, vectorized lookup.
+
+	:param cosmology: astropy cosmology. By default, a flat LambdaCDM
+		cosmology with H0=70 and Omega_m=0.3 is used.
+	:param zmax: largest redshift tabulated.
+	"""
+	def __init__(self, cosmology=None, zmax=10, npoints=4000):
+		if cosmology is None:
+			from astropy.cosmology import FlatLambdaCDM
+			cosmology = FlatLambdaCDM(H0=70, Om0=0.3)
+		self.z = numpy.linspace(0, zmax, npoints)
+		self.dL = cosmology.luminosity_distance(self.z).to('cm').value
+
+	def __call__(self, z):
+		assert numpy.all(z <= self.z[-1]), 'redshift beyond tabulated range'
+		return numpy.interp(z, self.z, self.dL)
+
+
+def calc_band_fluxes(
+	parameters, rows, model, bands, restframe_bands=(), redshift=None,
+	cosmology=None, nbins=2000
+):
+	"""Compute fluxes in several bands with one model evaluation per row.
+
+	:param parameters: list of parameters, matching the columns of *rows*
+	:param rows: parameter values, e.g., equally weighted posterior samples
+	:param model: unconvolved source model to integrate
+	:param bands: list of (elo, ehi) observed-frame energy bands in keV.
+	:param restframe_bands: list of (elo, ehi) rest-frame energy bands in keV,
+		for which energy fluxes and luminosities are computed.
+	:param redshift: parameter (or constant) giving the redshift
+	:param cosmology: astropy cosmology for the luminosity distance.
+	:param nbins: number of bins of the energy grid the model is evaluated on.
+
+	Returns a dictionary of arrays, with one entry per row:
+	photon_flux_<elo>-<ehi> (in phot/cm^2/s) and energy_flux_<elo>-<ehi>
+	(in erg/cm^2/s) for each observed-frame band, and for each rest-frame band
+	restframe_energy_flux_<elo>-<ehi> (erg/cm^2/s) and luminosity_<elo>-<ehi> (erg/s).
+	"""
+	rows = numpy.asarray(rows)
+	if len(rows) == 0:
+		keys = ['%s_%s-%s' % (kind, lo, hi) for lo, hi in bands for kind in ('photon_flux', 'energy_flux')]
+		keys += ['%s_%s-%s' % (kind, lo, hi) for lo, hi in restframe_bands for kind in ('restframe_energy_flux', 'luminosity')]
+		return {key: numpy.empty(0) for key in keys}
+	redshift_columns = [i for i, p in enumerate(parameters) if p is redshift]
+	if redshift_columns:
+		z = rows[:, redshift_columns[0]]
+	elif redshift is None:
+		z = numpy.zeros(len(rows))
+	else:
+		z = numpy.ones(len(rows)) * getattr(redshift, 'val', redshift)
+	egrid = create_flux_grid(bands, z.min(), z.max(), restframe_bands, nbins=nbins)
+	elo, ehi = egrid[:-1], egrid[1:]
+	emid_erg = (elo + ehi) / 2 * keV_to_erg
+	band_lo = numpy.array([lo for lo, hi in bands])
+	band_hi = numpy.array([hi for lo, hi in bands])
+	restband_lo = numpy.array([lo for lo, hi in restframe_bands])
+	restband_hi = numpy.array([hi for lo, hi in restframe_bands])
+
+	photon_flux = numpy.empty((len(rows), len(bands)))
+	energy_flux = numpy.empty((len(rows), len(bands)))
+	restframe_flux = numpy.empty((len(rows), len(restframe_bands)))
+	cumflux = numpy.zeros((2, len(egrid)))
+	for j, row in enumerate(tqdm(rows, disable=None)):
+		for p, v in zip(parameters, row):
+			p.val = v
+		photons = model(elo, ehi)
+		# all bands are integrated from the cumulative fluxes along the grid
+		numpy.cumsum(photons, out=cumflux[0,1:])
+		numpy.cumsum(photons * emid_erg, out=cumflux[1,1:])
+		photon_flux[j] = numpy.interp(band_hi, egrid, cumflux[0]) - numpy.interp(band_lo, egrid, cumflux[0])
+		energy_flux[j] = numpy.interp(band_hi, egrid, cumflux[1]) - numpy.interp(band_lo, egrid, cumflux[1])
+		restframe_flux[j] = numpy.interp(restband_hi / (1 + z[j]), egrid, cumflux[1]) - numpy.interp(restband_lo / (1 + z[j]), egrid, cumflux[1])
+
+	results = {}
+	for k, (lo, hi) in enumerate(bands):
+		results['photon_flux_%s-%s' % (lo, hi)] = photon_flux[:,k]
+		results['energy_flux_%s-%s' % (lo, hi)] = energy_flux[:,k]
+	if restframe_bands:
+		luminosity_distance = LuminosityDistance(cosmology, zmax=max(10, z.max()))
+		dL = luminosity_distance(z)
+		for k, (lo, hi) in enumerate(restframe_bands):
+			results['restframe_energy_flux_%s-%s' % (lo, hi)] = restframe_flux[:,k]
+			results['luminosity_%s-%s' % (lo, hi)] = 4 * numpy.pi * dL**2 * restframe_flux[:,k]
+	return results
@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+BXA (Bayesian X-ray Analysis) for Sherpa
+
+Copyright: Johannes Buchner (C) 2013-2025
+
+Caching of model sub-expressions during a fit.
+"""
+
+import os
+import copy
+import warnings
+import numpy
+
+from .cachedmodel import VariableCachedModel
+
+if 'MAKESPHINXDOC' not in os.environ:
+	import sherpa.astro.ui as ui
+	from sherpa.models.model import Model, ArithmeticModel, BinaryOpModel, UnaryOpModel
+	try:
+		from sherpa.astro.xspec import XSAdditiveModel
+	except ImportError:
+		XSAdditiveModel = None
+
+
+def is_constant(model):
+	"""Whether all parameters of *model* are frozen and not linked
+	to other parameters, so that its output only depends on the grid."""
+	pars = model.pars
+	return len(pars) > 0 and all(p.frozen and p.link is None for p in pars)
+
+
+class NormalisedCachedModel(VariableCachedModel):
+	"""Cache of an additive model with a normalisation parameter.
+
+	The model is computed and stored for norm=1, and the result is
+	rescaled, so that a change of only the normalisation does not
+	require computing the model again.
+
+	:param othermodel: additive sherpa model
+	:param norm: normalisation parameter of *othermodel*
+	"""
+	def __init__(self, othermodel, norm, maxsize=16, maxbytes=None):
+		VariableCachedModel.__init__(self, othermodel, maxsize=maxsize, maxbytes=maxbytes)
+		self.inorm = [i for i, par in enumerate(othermodel.pars) if par is norm][0]
+
+	def calc(self, p, left, *args, **kwargs):
+		p = numpy.array(p, dtype=float)
+		norm = p[self.inorm]
+		p[self.inorm] = 1.0
+		return VariableCachedModel.calc(self, p, left, *args, **kwargs) * norm
+
+
+def create_component_cache(model, maxsize):
+	"""Cached wrapper of a single model component."""
+	norm = getattr(model, 'norm', None)
+	if XSAdditiveModel is not None and isinstance(model, XSAdditiveModel) and norm is not None:
+		return NormalisedCachedModel(model, norm, maxsize=maxsize)
+	return VariableCachedModel(model, maxsize=maxsize)
+
+
+def is_response_wrapper(model):
+	"""Whether *model* applies a response (ARF/RMF) to a single inner model
+	expression, as returned by get_response(id)(model)."""
+	inner = getattr(model, 'model', None)
+	return isinstance(inner, Model) and tuple(getattr(model, 'parts', ())) == (inner,)
+
+
+def cache_subexpressions(model, maxsize=8, memo=None, components=False):
+	"""Replace the largest sub-expressions of *model* with constant
+	output by cached wrappers (VariableCachedModel).
+
+	:param model: sherpa model expression
+	:param maxsize: number of energy grids (and parameter values, for components)
+		stored by each wrapper.
+	:param memo: dictionary of already created wrappers, by id of
+		the wrapped model. Pass the same dictionary for several
+		expressions to share wrappers of common sub-expressions.
+	:param components: if True, also wrap each component with free parameters,
+		so that it is only computed again when its own parameters change.
+		Additive XSPEC components are stored for norm=1 and rescaled.
+
+	Returns the new expression (*model* itself if nothing changed).
+	"""
+	if memo is None:
+		memo = {}
+	if id(model) in memo:
+		return memo[id(model)]
+	if isinstance(model, ArithmeticModel) and is_constant(model):
+		new = VariableCachedModel(model, maxsize=maxsize)
+	elif isinstance(model, BinaryOpModel):
+		lhs = cache_subexpressions(model.lhs, maxsize, memo, components)
+		rhs = cache_subexpressions(model.rhs, maxsize, memo, components)
+		if lhs is model.lhs and rhs is model.rhs:
+			new = model
+		else:
+			new = BinaryOpModel(lhs, rhs, model.op, model.opstr)
+	elif isinstance(model, UnaryOpModel):
+		arg = cache_subexpressions(model.arg, maxsize, memo, components)
+		new = model if arg is model.arg else UnaryOpModel(arg, model.op, model.opstr)
+	elif is_response_wrapper(model):
+		# full models (set_full_model) contain the source expression inside the response
+		inner = cache_subexpressions(model.model, maxsize, memo, components)
+		if inner is model.model:
+			new = model
+		else:
+			new = copy.copy(model)
+			new.model = inner
+			new.parts = (inner,)
+	elif components and isinstance(model, ArithmeticModel) and len(model.pars) > 0 and not isinstance(model, VariableCachedModel):
+		new = create_component_cache(model, maxsize)
+	else:
+		new = model
+	memo[id(model)] = new
+	return new
+
+
+def cached_wrappers(memo):
+	"""List the cached wrappers created with *memo*."""
+	wrappers = []
+	for new in memo.values():
+		if isinstance(new, VariableCachedModel) and all(new is not w for w in wrappers):
+			wrappers.append(new)
+	return wrappers
+
+
+class SubexpressionCache(object):
+	"""
+	Temporarily replace the source models of datasets by expressions
+	in which sub-expressions with only frozen parameters
+	(for example galactic absorption, or fixed background shapes)
+	are computed once per energy grid and then reused.
+
+	With *components*, every other component is also cached by
+	its own parameter values, so that for example an expensive
+	table model is not computed again when only a normalisation
+	or another component changes.
+
+	Usage::
+
+		with SubexpressionCache(ids):
+			...  # fit, sample
+
+	The original source expressions are set again on exit.
+	For datasets with models set with set_full_model, the full model
+	is used, including the source expression inside the response.
+
+	:param ids: dataset identifiers
+	:param maxsize: number of results stored by each cached sub-expression.
+	:param components: also cache components with free parameters.
+	"""
+	def __init__(self, ids, maxsize=8, components=False):
+		self.ids = list(ids)
+		self.maxsize = maxsize
+		self.components = components
+		self.originals = {}
+		self.wrappers = []
+
+	def apply(self):
+		memo = {}
+		for i in self.ids:
+			try:
+				source = ui.get_source(i)
+				setter = ui.set_source
+			except Exception:
+				# no source expression: the model was set with set_full_model
+				try:
+					source = ui.get_model(i)
+					setter = ui.set_full_model
+				except Exception as e:
+					warnings.warn('dataset %s: model not cached (%s)' % (i, e))
+					continue
+			new = cache_subexpressions(source, maxsize=self.maxsize, memo=memo, components=self.components)
+			if new is not source:
+				self.originals[i] = (setter, source)
+				setter(i, new)
+		self.wrappers = cached_wrappers(memo)
+		return self
+
+	def restore(self):
+		for i, (setter, source) in self.originals.items():
+			setter(i, source)
+		self.originals = {}
+
+	def report(self):
+		"""Usage of each cached sub-expression.
+
+		Returns a list of dictionaries with the name of the sub-expression,
+		the free parameters it depends on, the number of cache hits and misses,
+		and the fraction of calls answered from the cache ('reuse').
+		"""
+		return [dict(
+			name=w.othermodel.name,
+			parameters=[p.fullname for p in w.pars if not p.frozen],
+			hits=w.hits, misses=w.misses, reuse=w.hit_rate)
+			for w in self.wrappers]
+
+	def __enter__(self):
+		return self.apply()
+
+	def __exit__(self, *args):
+		self.restore()
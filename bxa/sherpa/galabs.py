@@ -11,7 +11,6 @@ if 'MAKESPHINXDOC' not in os.environ:
 	import sherpa.astro.ui as ui
 	from sherpa.stats import Cash, CStat
 
-from .cachedmodel import CachedModel
 
 def auto_galactic_absorption(id=None):
 	#model = ui._session.get_model(id).model
@@ -23,8 +22,6 @@ def auto_galactic_absorption(id=None):
 	galabso.nH = nH / 1e22
 	print(('setting galactic nH to %s [units of 1e22/cm²]' % (galabso.nH.val)))
 	galabso.nH.freeze()
+	# as nH is frozen, BXASolver.run computes this component only once (cache_frozen)
 	return galabso
-	cgalabso = CachedModel(galabso)
-	print('returning cached galaxy absorption model')
-	return cgalabso
 	#ui._session.set_model(id, galabsmodel)
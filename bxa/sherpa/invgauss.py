@@ -350,7 +350,9 @@ interpy = numpy.array([
 interpx = numpy.linspace(0, 1, len(interpy))
 
 def get_invgauss_func(mu, sigma):
-	return lambda x: mu + sigma * numpy.interp(x, interpx, interpy)
+	f = lambda x: mu + sigma * numpy.interp(x, interpx, interpy)
+	f.kernel = ('table', interpx, mu + sigma * interpy)
+	return f
 	
 if __name__ == '__main__':
 	import scipy.stats
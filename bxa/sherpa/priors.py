@@ -8,7 +8,7 @@ Copyright: Johannes Buchner (C) 2013-2025
 
 Priors
 """
-from math import log10, erf
+from math import log10
 import numpy
 from . import invgauss
 
@@ -21,7 +21,10 @@ def create_uniform_prior_for(parameter):
 	"""
 	spread = (parameter.max - parameter.min)
 	low = parameter.min
-	return lambda x: x * spread + low
+	def uniform_transform(x):
+		return x * spread + low
+	uniform_transform.kernel = ('affine', spread, low)
+	return uniform_transform
 
 def create_jeffreys_prior_for(parameter):
 	"""deprecated name for create_loguniform_prior_for"""
@@ -46,7 +49,10 @@ def create_loguniform_prior_for(parameter):
 	assert parameter.min > 0 and parameter.max > 0, ('The limits of "%s" (min and max) are not positive.' % parameter.fullname)
 	low = log10(parameter.min)
 	spread = log10(parameter.max) - log10(parameter.min)
-	return lambda x: 10**(x * spread + low)
+	def loguniform_transform(x):
+		return 10**(x * spread + low)
+	loguniform_transform.kernel = ('logaffine', spread, low)
+	return loguniform_transform
 
 
 def create_gaussian_prior_for(parameter, mean, std):
@@ -61,15 +67,15 @@ def create_gaussian_prior_for(parameter, mean, std):
 	:param std: Standard deviation of the Gaussian
 
 	"""
-	import scipy.stats
+	from scipy.special import ndtr, ndtri
 	lo = parameter.min
 	hi = parameter.max
 
-	rv = scipy.stats.norm(mean, std)
-	xlo = rv.cdf(lo)
-	xhi = rv.cdf(hi)
+	xlo = ndtr((lo - mean) / std)
+	xhi = ndtr((hi - mean) / std)
 	def gauss_transform(x):
-		return rv.ppf(x * (xhi - xlo) + xlo)
+		return ndtri(x * (xhi - xlo) + xlo) * std + mean
+	gauss_transform.kernel = ('gauss', xhi - xlo, xlo, std, mean)
 
 	return gauss_transform
 
@@ -91,14 +97,55 @@ def prior_from_file(filename, parameter):
 	if numpy.shape(dist) == ():
 		parameter.val = float(dist)
 		return float(dist), [], []
-	distz = numpy.array(list(dist[:, 1]) + [dist[-1,1]]*2)
+	xp = dist[:,0]
+	fp = dist[:,1]
 	def custom_priorf(x):
-		assert x >= 0
-		assert x <= 1
-		r = numpy.interp(x, dist[:,0], dist[:,1])
-		return r
+		return numpy.interp(x, xp, fp)
+	custom_priorf.kernel = ('table', xp, fp)
 	return parameter, [parameter], [custom_priorf]
 
+def compile_prior_transform(functions):
+	"""
+	Combine prior transformations into a single function acting on arrays.
+
+	Transformations created with create_uniform_prior_for,
+	create_loguniform_prior_for, create_gaussian_prior_for and
+	prior_from_file are fused into a few NumPy operations on whole columns.
+	Other transformations are called element by element.
+
+	:param functions: list of individual prior transforms, one per parameter.
+
+	Returns a function transforming an array of shape (N, ndim) in place.
+	"""
+	kinds = [getattr(f, 'kernel', ('custom',)) for f in functions]
+	affine = [i for i, k in enumerate(kinds) if k[0] in ('affine', 'logaffine')]
+	scale = numpy.array([kinds[i][1] for i in affine])
+	offset = numpy.array([kinds[i][2] for i in affine])
+	logmask = numpy.array([kinds[i][0] == 'logaffine' for i in affine], dtype=bool)
+	gauss = [i for i, k in enumerate(kinds) if k[0] == 'gauss']
+	gauss_params = numpy.array([kinds[i][1:] for i in gauss]).reshape((-1, 4)).transpose()
+	tables = [(i, kinds[i][1], kinds[i][2]) for i, k in enumerate(kinds) if k[0] == 'table']
+	custom = [(i, functions[i]) for i, k in enumerate(kinds) if k[0] == 'custom']
+	if gauss:
+		from scipy.special import ndtri
+
+	def transform(cube):
+		if affine:
+			v = cube[:, affine] * scale + offset
+			v[:, logmask] = 10**v[:, logmask]
+			cube[:, affine] = v
+		if gauss:
+			spread, low, std, mean = gauss_params
+			cube[:, gauss] = ndtri(cube[:, gauss] * spread + low) * std + mean
+		for i, xp, fp in tables:
+			cube[:, i] = numpy.interp(cube[:, i], xp, fp)
+		for i, f in custom:
+			cube[:, i] = [f(x) for x in cube[:, i]]
+		return cube
+
+	return transform
+
+
 def create_prior_function(priors = [], parameters = None):
 	"""
 	Combine the prior transformations into a single function.
@@ -109,20 +156,21 @@ def create_prior_function(priors = [], parameters = None):
 		If priors is empty, uniform priors are used on all passed parameters
 	:param parameters: If priors is empty, specify the list of parameters.
 		Uniform priors will be created for them.
+
+	The returned function transforms *cube* in place. *cube* can be a
+	single point or an array of shape (N, ndim).
 	"""
 
 	if priors == []:
-		functions = []
 		assert parameters is not None, "you need to pass the parameters if you want automatic uniform priors"
-		thawedparmins  = [p.min for p in parameters]
-		thawedparmaxes = [p.max for p in parameters]
-		for low, high in zip(thawedparmins, thawedparmaxes):
-			functions.append(lambda x: x * (high - low) + low)
+		functions = [create_uniform_prior_for(p) for p in parameters]
 	else:
 		functions = priors
-    
+
+	transform = compile_prior_transform(functions)
+
 	def prior_function(cube, ndim, nparams):
-		for i in range(ndim):
-			cube[i] = functions[i](cube[i])
+		transform(cube.reshape((-1, ndim)))
 
+	prior_function.vectorized = True
 	return prior_function
@@ -5,6 +5,8 @@ That model can then be used for fast access.
 """
 
 import os
+import json
+import hashlib
 
 if 'MAKESPHINXDOC' not in os.environ:
 	from sherpa.astro.ui import *
@@ -14,15 +16,13 @@ else:
 	ArithmeticModel = object
 
 import itertools
+import multiprocessing
+import shutil
+import warnings
+from collections import OrderedDict
 import numpy
 from tqdm import tqdm
 
-"""
-custom interpolation code, needs
-https://github.com/JohannesBuchner/npyinterp
-"""
-from monointerp import interp
-
 
 """
 slowmodel:
@@ -44,8 +44,12 @@ parameters:
    Note that all parameters that are not varied are fixed and should be set to 
    the right (fixed) values.
    
-   Note that the interpolation is always linear in the parameters. If you would
-   like a interpolation in logarithmic gridding, introduce a helper parameter:
+   Instead of the number of grid points, (param, nbins, 'log') gives a
+   logarithmically spaced axis (the interpolation is then linear in the
+   logarithm of the parameter), and (param, values) an axis with the
+   given, possibly non-uniform, grid values.
+   
+   Alternatively, for interpolation in logarithmic gridding, introduce a helper parameter:
    
      # create helper parameter
      lognH = Parameter(modelname='mymodel', name='nH', val=20, min=20, max=26,
@@ -57,57 +61,512 @@ parameters:
         (lognH, 21),
         (warmabs.myabs.ionisation, 10),
      ]
+
+filename:
+   file to store the grid in. The grid is stored uncompressed as a .npy file,
+   which is memory-mapped when loaded, so that processes on the same machine
+   share one copy through the page cache. The energy bins, parameter axes and
+   a fingerprint of the slow model are stored in filename + '.json'.
+   A filename ending in .npz selects the older, compressed format, which is
+   loaded fully into memory.
+nprocesses:
+   number of processes computing the grid. Workers are forked, so
+   they have a copy of the slow model.
+interpolation:
+   'nearest' uses the model of the nearest grid point.
+   'linear' interpolates multilinearly between the surrounding grid points,
+   which gives smooth models with coarser grids.
+chunksize:
+   number of grid points per chunk. Finished chunks are stored in
+   the directory filename + '.chunks', so that an interrupted
+   construction only computes the missing chunks when started again.
+refine:
+   if given (a dictionary of options for refine_axes, for example
+   dict(rtol=0.01)), the grid values in *parameters* are only the start.
+   Grid values are added where interpolation between neighbouring grid
+   points differs from the slow model by more than rtol, giving a
+   non-uniform grid. The refinement and a validation of the final grid at
+   random points are reported in the model attribute refinement, and
+   stored with the grid, together with the refine options, parameters,
+   initial grid values and scales. A stored grid refined with a different
+   setup raises an error.
    
 """
+
+# grid construction setup; forked worker processes inherit it
+_grid_setup = None
+
+
+def evaluate_slowmodel(slowmodel, params, element, left, right):
+	"""Compute *slowmodel* with the parameters *params* set to *element*."""
+	for i, p in enumerate(params):
+		if p.val != element[i]:
+			p.val = element[i]
+	values = [p.val for p in slowmodel.pars]
+	return slowmodel.calc(values, left, right)
+
+
+def _compute_chunk(k):
+	"""Compute the models of chunk *k* of the grid."""
+	slowmodel, params, bins, left, right, chunksize = _grid_setup
+	elements = itertools.islice(itertools.product(*bins), k * chunksize, (k + 1) * chunksize)
+	data = [evaluate_slowmodel(slowmodel, params, element, left, right) for element in elements]
+	return k, numpy.array(data)
+
+
+def compute_grid(slowmodel, ebins, params, bins, chunkdir, nprocesses=1, chunksize=100, out=None):
+	"""Compute *slowmodel* for all combinations of parameter values *bins*.
+
+	Chunks of *chunksize* grid points are computed in *nprocesses*
+	processes, and stored in *chunkdir* as they finish. Chunks already
+	present in *chunkdir* are not computed again.
+
+	Returns the grid, with one row per combination of parameter values.
+	If *out* (for example a memory-mapped array) is given, the grid is
+	assembled into it.
+	"""
+	global _grid_setup
+	ntot = int(numpy.prod([len(bin) for bin in bins]))
+	nchunks = (ntot + chunksize - 1) // chunksize
+	os.makedirs(chunkdir, exist_ok=True)
+	setupfile = os.path.join(chunkdir, 'setup.npz')
+	if os.path.exists(setupfile):
+		setup = numpy.load(setupfile)
+		same = (
+			numpy.array_equal(setup['x'], ebins) and int(setup['chunksize']) == chunksize
+			and len(setup.files) == len(bins) + 2
+			and all(numpy.array_equal(setup['bins%d' % i], bin) for i, bin in enumerate(bins)))
+		assert same, 'grid setup differs from stored chunks -- please delete "%s"' % chunkdir
+	else:
+		numpy.savez(setupfile, x=ebins, chunksize=chunksize, **{'bins%d' % i: bin for i, bin in enumerate(bins)})
+
+	def chunkfile(k):
+		return os.path.join(chunkdir, 'chunk%05d.npy' % k)
+
+	todo = [k for k in range(nchunks) if not os.path.exists(chunkfile(k))]
+	if len(todo) < nchunks:
+		print('   %d of %d chunks already computed' % (nchunks - len(todo), nchunks))
+
+	def store(k, data):
+		# write to a temporary file first, so an interruption does not leave a partial chunk
+		with open(chunkfile(k) + '.tmp', 'wb') as f:
+			numpy.save(f, data)
+		os.replace(chunkfile(k) + '.tmp', chunkfile(k))
+
+	_grid_setup = (slowmodel, params, bins, ebins[:-1], ebins[1:], chunksize)
+	try:
+		ndone = ntot - sum(min(chunksize, ntot - k * chunksize) for k in todo)
+		with tqdm(total=ntot, initial=ndone, disable=None) as pbar:
+			if nprocesses > 1 and len(todo) > 1:
+				context = multiprocessing.get_context('fork')
+				with context.Pool(nprocesses) as pool:
+					for k, data in pool.imap_unordered(_compute_chunk, todo):
+						store(k, data)
+						pbar.update(len(data))
+			else:
+				for k in todo:
+					k, data = _compute_chunk(k)
+					store(k, data)
+					pbar.update(len(data))
+	finally:
+		_grid_setup = None
+	if out is None:
+		return numpy.vstack([numpy.load(chunkfile(k)) for k in range(nchunks)])
+	for k in range(nchunks):
+		out[k * chunksize:(k + 1) * chunksize] = numpy.load(chunkfile(k))
+	return out
+
+
+def grid_fingerprint(slowmodel, params):
+	"""Hash of the slow model expression and its fixed parameter values.
+
+	Gridded parameters, and parameters linked to other parameters, are
+	not included, because their values change during the grid construction.
+	"""
+	h = hashlib.sha1(slowmodel.name.encode())
+	for p in slowmodel.pars:
+		if any(p is q for q in params) or p.link is not None:
+			continue
+		h.update(('|%s=%r' % (p.fullname, float(p.val))).encode())
+	return h.hexdigest()
+
+
+def grid_metadata(ebins, params, bins, scales, fingerprint):
+	"""Metadata header describing a stored grid."""
+	return dict(
+		x=[float(e) for e in ebins],
+		axes=[dict(name=param.fullname, scale=scale, values=[float(v) for v in bin])
+			for param, bin, scale in zip(params, bins, scales)],
+		fingerprint=fingerprint)
+
+
+def read_metadata(filename):
+	"""Metadata header of the grid stored in *filename*, or None if there is no complete grid."""
+	if not os.path.exists(filename + '.json'):
+		return None
+	with open(filename + '.json') as f:
+		return json.load(f)
+
+
+def load_grid(filename, metadata):
+	"""Memory-map the grid stored in *filename*.
+
+	Returns None if there is no complete grid. Raises an error if the
+	stored grid was made with a different setup than *metadata*.
+	"""
+	stored = read_metadata(filename)
+	if stored is None:
+		return None
+	assert numpy.allclose(stored['x'], metadata['x']), 'energy binning differs -- please delete "%s"' % filename
+	assert len(stored['axes']) == len(metadata['axes']) and all(
+		a['scale'] == b['scale'] and numpy.allclose(a['values'], b['values'])
+		for a, b in zip(stored['axes'], metadata['axes'])), 'parameter axes differ -- please delete "%s"' % filename
+	if stored['fingerprint'] != metadata['fingerprint']:
+		print('warning: the slow model or its fixed parameters differ from the ones used for "%s"' % filename)
+	return numpy.load(filename, mmap_mode='r')
+
+
+def save_grid(filename, metadata, compute):
+	"""Store a grid of models as a .npy file, with *metadata* in filename + '.json'.
+
+	*compute* receives a memory-mapped output array of the grid shape
+	and fills it. The metadata are written last, so that an incomplete
+	grid is never loaded.
+	"""
+	from numpy.lib.format import open_memmap
+	ntot = int(numpy.prod([len(axis['values']) for axis in metadata['axes']]))
+	out = open_memmap(filename + '.part.npy', mode='w+', dtype=float, shape=(ntot, len(metadata['x']) - 1))
+	compute(out)
+	out.flush()
+	del out
+	os.replace(filename + '.part.npy', filename)
+	with open(filename + '.json.tmp', 'w') as f:
+		json.dump(metadata, f)
+	os.replace(filename + '.json.tmp', filename + '.json')
+	return numpy.load(filename, mmap_mode='r')
+
+
+def make_axis(param, spec, scale='linear'):
+	"""Grid values of *param* for the grid specification *spec*.
+
+	*spec* is either the number of grid points between param.min and
+	param.max (spaced according to *scale*), or the list of grid values.
+	"""
+	if numpy.ndim(spec) == 0:
+		if scale == 'log':
+			return numpy.geomspace(param.min, param.max, spec)
+		return numpy.linspace(param.min, param.max, spec)
+	axis = numpy.asarray(spec, dtype=float)
+	assert (numpy.diff(axis) > 0).all(), 'grid values of %s must be increasing' % param.fullname
+	return axis
+
+
+def interpolation_weights(axes, scales, coords):
+	"""Multilinear interpolation weights on a rectilinear grid.
+
+	:param axes: list of grid values along each parameter axis
+	:param scales: list of 'linear' or 'log', the space in which each axis is interpolated
+	:param coords: parameter values, shape (N, number of axes)
+
+	Returns the indices into the flattened grid and the weights of
+	the 2**(number of axes) surrounding grid points, both of shape (N, 2**(number of axes)).
+	Coordinates outside the grid are moved to its edge.
+	"""
+	coords = numpy.asarray(coords, dtype=float).reshape((-1, len(axes)))
+	shape = tuple(len(axis) for axis in axes)
+	lower = []
+	fractions = []
+	for axis, scale, c in zip(axes, scales, coords.transpose()):
+		if scale == 'log':
+			axis = numpy.log(axis)
+			c = numpy.log(c)
+		k = numpy.clip(numpy.searchsorted(axis, c, side='right') - 1, 0, max(len(axis) - 2, 0))
+		if len(axis) > 1:
+			t = numpy.clip((c - axis[k]) / (axis[k + 1] - axis[k]), 0, 1)
+		else:
+			t = numpy.zeros(len(c))
+		lower.append(k)
+		fractions.append(t)
+	corners = list(itertools.product((0, 1), repeat=len(axes)))
+	indices = numpy.empty((len(coords), len(corners)), dtype=int)
+	weights = numpy.ones((len(coords), len(corners)))
+	for j, corner in enumerate(corners):
+		index = [numpy.minimum(k + o, n - 1) for k, o, n in zip(lower, corner, shape)]
+		indices[:,j] = numpy.ravel_multi_index(index, shape)
+		for t, o in zip(fractions, corner):
+			weights[:,j] *= t if o else 1 - t
+	return indices, weights
+
+
+def relative_error(approx, exact):
+	"""Sum of absolute differences, relative to the sum of *exact*."""
+	total = numpy.abs(exact).sum()
+	diff = numpy.abs(numpy.asarray(approx) - exact).sum()
+	return float(diff / total) if total > 0 else float(diff > 0)
+
+
+def _midpoint(lo, hi, scale):
+	return (lo * hi)**0.5 if scale == 'log' else (lo + hi) / 2.
+
+
+def refine_axes(slowmodel, ebins, params, axes, scales, rtol=0.01, nprobe=10, max_iterations=10, max_points=None, seed=1):
+	"""Add grid values where linear interpolation is not accurate enough.
+
+	In each iteration, every interval between neighbouring grid values of
+	each axis is tested: at *nprobe* randomly chosen grid positions of the
+	other axes, the slow model at the midpoint of the interval (in the
+	space given by the scale of the axis) is compared to the interpolation
+	between the two end points. Intervals where the largest relative error
+	(see relative_error) exceeds *rtol* are split at the midpoint.
+
+	:param slowmodel: model to grid
+	:param ebins: energy bin edges
+	:param params: parameters of the axes
+	:param axes: initial grid values of each axis
+	:param scales: 'linear' or 'log' for each axis
+	:param rtol: tolerated relative error
+	:param nprobe: number of positions on the other axes to test each interval at
+	:param max_iterations: maximum number of refinement iterations
+	:param max_points: maximum number of grid points (default: no limit)
+	:param seed: random seed for choosing the test positions
+
+	Returns the refined axes and a report: the errors of the intervals of
+	each axis and the largest of them (if the final intervals were tested),
+	whether it is within *rtol* ('converged'), whether *max_points* prevented
+	further refinement ('capped'), and for each iteration, the number of
+	intervals tested and split.
+	"""
+	left = ebins[:-1]
+	right = ebins[1:]
+	rng = numpy.random.default_rng(seed)
+	axes = [numpy.asarray(axis, dtype=float) for axis in axes]
+	computed = {}
+
+	def evaluate(element):
+		element = tuple(float(v) for v in element)
+		if element not in computed:
+			computed[element] = numpy.array(evaluate_slowmodel(slowmodel, params, element, left, right), dtype=float)
+		return computed[element]
+
+	iterations = []
+	errors = [None] * len(axes)
+	capped = False
+	for iteration in tqdm(range(max_iterations), disable=None):
+		nsplit = 0
+		ntested = 0
+		worst = 0.0
+		new_axes = []
+		for d, (axis, scale) in enumerate(zip(axes, scales)):
+			others = [a for e, a in enumerate(axes) if e != d]
+			nothers = int(numpy.prod([len(a) for a in others]))
+			chosen = rng.choice(nothers, size=min(nprobe, nothers), replace=False)
+			probes = [[a[i] for a, i in zip(others, numpy.unravel_index(j, [len(a) for a in others]))] for j in chosen]
+			errors[d] = []
+			splits = []
+			for lo, hi in zip(axis[:-1], axis[1:]):
+				mid = _midpoint(lo, hi, scale)
+				error = 0.0
+				for probe in probes:
+					elements = [probe[:d] + [v] + probe[d:] for v in (lo, mid, hi)]
+					ylo, ymid, yhi = [evaluate(e) for e in elements]
+					error = max(error, relative_error((ylo + yhi) / 2., ymid))
+				errors[d].append(error)
+				if error > rtol:
+					splits.append((error, mid))
+			ntested += len(axis) - 1
+			worst = max([worst] + errors[d])
+			if max_points is not None:
+				# grid points for each value of this axis, with the axes refined so far
+				size = int(numpy.prod([len(a) for a in new_axes + axes[d + 1:]]))
+				allowed = max(0, max_points // size - len(axis))
+				if len(splits) > allowed:
+					# split the intervals with the largest errors first
+					capped = True
+					splits = sorted(splits, reverse=True)[:allowed]
+			splits = [mid for error, mid in splits]
+			nsplit += len(splits)
+			new_axes.append(numpy.sort(numpy.concatenate((axis, splits))))
+		iterations.append(dict(tested=ntested, split=nsplit, max_error=worst))
+		if nsplit == 0:
+			break
+		axes = new_axes
+		errors = [None] * len(axes)
+
+	# largest error of the final intervals, if they were all tested
+	tested = all(e is not None for e in errors)
+	max_error = max([0.0] + [error for e in errors for error in e]) if tested else None
+	if capped:
+		warnings.warn('grid refinement reached max_points=%d; largest interval error: %s, rtol: %s' % (max_points, max_error, rtol))
+	report = dict(
+		rtol=rtol,
+		converged=max_error is not None and max_error <= rtol,
+		capped=capped,
+		max_error=max_error,
+		iterations=iterations,
+		# errors of the final intervals, if they were tested
+		interval_errors={param.fullname: error for param, error in zip(params, errors)},
+		model_evaluations=len(computed))
+	return axes, report
+
+
+def validate_grid(slowmodel, ebins, params, axes, scales, data, rtol=0.01, nvalidate=100, seed=2):
+	"""Compare the multilinear interpolation of the grid *data* to the
+	slow model at *nvalidate* random points within the grid.
+
+	Returns a report with the largest and median relative error (see relative_error),
+	and the fraction of points with errors above *rtol*.
+	"""
+	left = ebins[:-1]
+	right = ebins[1:]
+	rng = numpy.random.default_rng(seed)
+	coords = numpy.empty((nvalidate, len(axes)))
+	for d, (axis, scale) in enumerate(zip(axes, scales)):
+		if scale == 'log':
+			coords[:,d] = numpy.exp(rng.uniform(numpy.log(axis[0]), numpy.log(axis[-1]), nvalidate))
+		else:
+			coords[:,d] = rng.uniform(axis[0], axis[-1], nvalidate)
+	indices, weights = interpolation_weights(axes, scales, coords)
+	errors = []
+	for c, index, weight in zip(coords, indices, weights):
+		exact = numpy.asarray(evaluate_slowmodel(slowmodel, params, c, left, right), dtype=float)
+		errors.append(relative_error(weight @ data[index], exact))
+	errors = numpy.array(errors)
+	if len(errors) == 0:
+		return dict(npoints=0)
+	return dict(
+		npoints=len(errors), max_error=float(errors.max()), median_error=float(numpy.median(errors)),
+		fraction_above_rtol=float((errors > rtol).mean()))
+
+
+def rebin_cumulative(x, cumulative, left, right):
+	"""Integrate binned spectra over new energy bins.
+
+	:param x: energy bin edges of the spectra (n+1 values)
+	:param cumulative: cumulative sums of the spectra at the edges *x*,
+		starting with 0, shape (N, n+1)
+	:param left: lower edges of the new bins, shape (M,) or (N, M)
+	:param right: upper edges of the new bins, shape (M,) or (N, M)
+
+	The cumulative spectra are interpolated linearly in energy (that is,
+	the spectra are constant within each bin), and are constant outside
+	the range of *x*. Returns the content of the new bins, shape (N, M).
+	"""
+	def at(e):
+		e = numpy.broadcast_to(e, (len(cumulative), numpy.shape(e)[-1]))
+		k = numpy.clip(numpy.searchsorted(x, e, side='right') - 1, 0, len(x) - 2)
+		t = numpy.clip((e - x[k]) / (x[k + 1] - x[k]), 0, 1)
+		lo = numpy.take_along_axis(cumulative, k, axis=1)
+		hi = numpy.take_along_axis(cumulative, k + 1, axis=1)
+		return lo + t * (hi - lo)
+
+	if numpy.shape(left)[-1] > 0 and numpy.array_equal(left[...,1:], right[...,:-1]):
+		# contiguous bins: evaluate each edge only once
+		edges = numpy.concatenate((left, right[...,-1:]), axis=-1)
+		return numpy.diff(at(edges), axis=1)
+	return at(right) - at(left)
+
+
 class RebinnedModel(ArithmeticModel):
-	def __init__(self, slowmodel, ebins, parameters, filename, modelname='rebinnedmodel'):
-		params = [param for param, nbins in parameters]
-	
-		bins = [numpy.linspace(param.min, param.max, nbins) for param, nbins in parameters]
-		left = ebins[:-1]
-		right = ebins[1:]
-		width = right - left
-		ntot = numpy.product([len(bin) for bin in bins])
-		try:
-			alldata = numpy.load(filename)
-			data = alldata['y']
-			assert numpy.allclose(alldata['x'], ebins), 'energy binning differs -- plese delete "%s"' % filename
+	def __init__(self, slowmodel, ebins, parameters, filename, modelname='rebinnedmodel',
+		nprocesses=1, chunksize=100, interpolation='nearest', cache_rows=10000, refine=None):
+		if interpolation not in ('nearest', 'linear'):
+			raise ValueError("interpolation must be 'nearest' or 'linear', not %s" % interpolation)
+		params = [param for param, *spec in parameters]
+		scales = [spec[1] if len(spec) > 1 else 'linear' for param, *spec in parameters]
+		bins = [make_axis(param, spec[0], scale) for (param, *spec), scale in zip(parameters, scales)]
+		compressed = filename.endswith('.npz')
+		data = None
+		self.refinement = None
+		if refine is not None:
+			if compressed:
+				raise ValueError('grid refinement needs the .npy storage, not "%s"' % filename)
+			self.refinement = self._refine(slowmodel, ebins, params, bins, scales, filename, refine)
+			bins = [numpy.array(values) for values in self.refinement['axes']]
+		if compressed:
+			if os.path.exists(filename):
+				alldata = numpy.load(filename)
+				data = alldata['y']
+				assert numpy.allclose(alldata['x'], ebins), 'energy binning differs -- plese delete "%s"' % filename
+		else:
+			metadata = grid_metadata(ebins, params, bins, scales, grid_fingerprint(slowmodel, params))
+			data = load_grid(filename, metadata)
+		if data is not None:
 			print('loaded from %s' % filename)
-		except IOError:
+		else:
 			print('creating rebinnedmodel, this might take a while')
 			print('interpolation setup:')
 			print('   energies:', ebins[0], ebins[1], '...', ebins[-2], ebins[-1])
-			for (param, nbins), bin in zip(parameters, bins):
-				print('   %s: %s - %s with %d points' % (param.fullname, param.min, param.max, nbins))
+			for param, bin in zip(params, bins):
+				print('   %s: %s - %s with %d points' % (param.fullname, bin[0], bin[-1], len(bin)))
 				print('        ', bin)
 		
-			data = numpy.zeros((ntot, len(ebins)-1))
-			for j, element in enumerate(tqdm(list(itertools.product(*bins)), disable=None)):
-				for i, p in enumerate(params):
-					if p.val != element[i]:
-						p.val = element[i]
-				values = [p.val for p in slowmodel.pars]
-				model = slowmodel.calc(values, left, right)
-				#assert numpy.isfinite(model).all(), ('model:', model)
-				#model = modelcum / width
-				#assert numpy.isfinite(model).all(), ('model', model)
-				data[j] = model
-				# (modelcum * width).cumsum()
-			print('model created. storing to %s' % filename)
-			numpy.savez(filename, x=ebins, y=data)
-		self.init(modelname=modelname, x=ebins, data=data, parameters=parameters) 
+			chunkdir = filename + '.chunks'
+			if compressed:
+				data = compute_grid(slowmodel, ebins, params, bins, chunkdir,
+					nprocesses=nprocesses, chunksize=chunksize)
+				print('model created. storing to %s' % filename)
+				numpy.savez(filename, x=ebins, y=data)
+			else:
+				def compute(out):
+					compute_grid(slowmodel, ebins, params, bins, chunkdir,
+						nprocesses=nprocesses, chunksize=chunksize, out=out)
+					if refine is not None:
+						self.refinement['validation'] = validate_grid(
+							slowmodel, ebins, params, bins, scales, out, rtol=refine.get('rtol', 0.01))
+						metadata['refinement'] = self.refinement
+				data = save_grid(filename, metadata, compute)
+				print('model created and stored to %s' % filename)
+				if os.path.exists(filename + '.refine.json'):
+					os.remove(filename + '.refine.json')
+			shutil.rmtree(chunkdir)
+		self.init(modelname=modelname, x=ebins, data=data, parameters=params,
+			axes=bins, scales=scales, interpolation=interpolation, cache_rows=cache_rows)
 	
-	def init(self, modelname, x, data, parameters):
+	@staticmethod
+	def _refine(slowmodel, ebins, params, bins, scales, filename, refine):
+		"""Refined axes, from the stored grid or refinement if available.
+
+		A stored refinement is only used if it was made with the same
+		refine options, parameters, initial grid values and scales.
+		"""
+		# compared after a round trip through json, as stored
+		setup = json.loads(json.dumps(dict(
+			options=refine, params=[param.fullname for param in params],
+			bins=[[float(v) for v in bin] for bin in bins], scales=list(scales))))
+		stored = read_metadata(filename)
+		if stored is not None and 'refinement' in stored:
+			if stored['refinement'].get('setup') != setup:
+				raise ValueError('grid refinement setup differs -- please delete "%s"' % filename)
+			return stored['refinement']
+		refinefile = filename + '.refine.json'
+		if os.path.exists(refinefile):
+			with open(refinefile) as f:
+				report = json.load(f)
+			if report.get('setup') == setup:
+				return report
+			print('refinement setup changed, refining again')
+		print('refining grid of %s' % slowmodel.name)
+		axes, report = refine_axes(slowmodel, ebins, params, bins, scales, **refine)
+		report['axes'] = [[float(v) for v in axis] for axis in axes]
+		report['setup'] = setup
+		for param, axis in zip(params, axes):
+			print('   %s: %d points' % (param.fullname, len(axis)))
+		# keep the refinement, in case the grid construction is interrupted
+		with open(refinefile, 'w') as f:
+			json.dump(report, f)
+		return report
+
+	def init(self, modelname, x, data, parameters, axes, scales, interpolation='nearest', cache_rows=10000):
 		#print 'BinReaderModel(%s)' % modelname
 		self.data = data
 		
 		pars = []
 		#print '  copying parameters'
-		for param, nbins in parameters:
-			lo = param.min
-			hi = param.max
+		for param, axis in zip(parameters, axes):
+			lo = axis[0]
+			hi = axis[-1]
 			newp = Parameter(modelname=modelname, name=param.name, 
-				val=param.val, min=lo, max=hi, hard_min=lo, hard_max=hi)
+				val=min(max(param.val, lo), hi), min=lo, max=hi, hard_min=lo, hard_max=hi)
 			setattr(self, param.name, newp)
 			pars.append(newp)
 		#print '  adding norm'
@@ -120,46 +579,81 @@ class RebinnedModel(ArithmeticModel):
 		pars.append(newp)
 		
 		self.x = x
-		self.binnings = [(param.min, param.max, nbins) for param, nbins in parameters]
+		self.axes = axes
+		self.scales = scales
+		self.interpolation = interpolation
+		# cumulative sums of recently used grid rows
+		self.cumulative = OrderedDict()
+		self.cache_rows = cache_rows
 		super(RebinnedModel, self).__init__(modelname, pars=pars)
-	def get(self, coords):
-		# compute row to access
+
+	def nearest_index(self, coords):
+		"""Grid row of the grid point nearest to *coords*."""
 		j = 0
-		for i, ((lo, hi, n), c) in list(enumerate(zip(self.binnings, coords))):
-			k = int((c - lo) * n / (hi - lo))
-			if k == n: 
-				k = n - 1
-			#print '  for param %d: %d/%d -> %d' % (i, k, n, j * n + k)
-			j = j * n + k
-		#print 'accessing', j
-		return self.data[j]
+		for axis, scale, c in zip(self.axes, self.scales, coords):
+			if scale == 'log':
+				axis = numpy.log(axis)
+				c = numpy.log(c)
+			k = numpy.clip(numpy.searchsorted(axis, c), 1, max(len(axis) - 1, 1))
+			if len(axis) == 1 or c - axis[k - 1] < axis[k] - c:
+				k -= 1
+			j = j * len(axis) + k
+		return j
+
+	def get(self, coords):
+		"""Model of the grid point nearest to *coords*."""
+		return self.data[self.nearest_index(coords)]
+
+	def get_weights(self, coords):
+		"""Grid rows and weights to combine for the parameter values *coords*
+		(shape (N, number of axes)), according to the interpolation mode."""
+		coords = numpy.asarray(coords, dtype=float).reshape((-1, len(self.axes)))
+		if self.interpolation == 'nearest':
+			indices = numpy.array([[self.nearest_index(c)] for c in coords], dtype=int).reshape((-1, 1))
+			return indices, numpy.ones(indices.shape)
+		return interpolation_weights(self.axes, self.scales, coords)
+
+	def get_batch(self, coords):
+		"""Models at the parameter values *coords* (shape (N, number of axes)),
+		using the interpolation mode of the model."""
+		indices, weights = self.get_weights(coords)
+		return numpy.einsum('nj,nje->ne', weights, self.data[indices])
+
+	def get_cumulative(self, indices):
+		"""Cumulative sums (starting with 0) of the grid rows *indices*.
+
+		The sums of recently used rows are kept, up to cache_rows rows."""
+		cumulative = self.cumulative
+		missing = [j for j in numpy.unique(indices) if j not in cumulative]
+		if missing:
+			rows = self.data[missing]
+			sums = numpy.zeros((len(missing), rows.shape[1] + 1))
+			numpy.cumsum(rows, axis=1, out=sums[:,1:])
+			for j, row in zip(missing, sums):
+				cumulative[j] = row
+		result = numpy.array([cumulative[j] for j in indices.flat]).reshape(indices.shape + (-1,))
+		for j in indices.flat:
+			cumulative.move_to_end(j)
+		while len(cumulative) > max(self.cache_rows, indices.size):
+			cumulative.popitem(last=False)
+		return result
+
+	def calc_batch(self, points, left, right):
+		"""Evaluate the model for each row of *points*.
+
+		:param points: parameter values (axes, norm, redshift), shape (N, number of parameters)
+		:param left: lower energy bin edges
+		:param right: upper energy bin edges
+
+		Returns an array of shape (N, number of bins).
+		"""
+		points = numpy.asarray(points, dtype=float).reshape((-1, len(self.axes) + 2))
+		indices, weights = self.get_weights(points[:,:-2])
+		# interpolating the cumulative spectra is the same as interpolating the spectra
+		cumulative = numpy.einsum('nj,nje->ne', weights, self.get_cumulative(indices))
+		shift = 1. + points[:,-1:]
+		result = rebin_cumulative(self.x, cumulative, left * shift, right * shift)
+		return result * points[:,-2:-1]
+
 	def calc(self, p, left, right, *args, **kwargs):
-		# print('  calc', p, left, right, args, kwargs)
-		coords = p[:-2]
-		norm = p[-2]
-		redshift = p[-1]
-		#print '    shifting ...'
-		shiftedleft  = left *(1.+redshift)
-		shiftedright = right*(1.+redshift)
-		x = self.x
-		#print '    getting ...'
-		y = self.get(coords)
-		#print '    y', y
-		
-		left = x[:-1]
-		right = x[1:]
-		width = right - left
-		assert (y >= 0).all()
-		yw = (y).cumsum()
-		#for a, b, c, d in zip(x, width, y, yw):
-		#	print '%.3f %.3f %.3f %.3f' % (a, b, c, d)
-		
-		#print '    y*w', y
-		#print '    interp ...'
-		r = interp(shiftedleft, shiftedright, x, yw)
-		#for a, b, c in zip(shiftedleft, shiftedright, r):
-		#	print '%.3f %.3f %.3f' % (a, b, c)
-		#print '    result', r
-		assert numpy.isfinite(r).all(), r
-		#print r[len(r)/2], yw[len(yw)/2], norm
-		return r * norm
+		return self.calc_batch(numpy.reshape(p, (1, -1)), left, right)[0]
@@ -8,11 +8,13 @@ Copyright: Johannes Buchner (C) 2013-2025
 """
 import os
 import numpy
-from math import isnan
-from ultranest.integrator import ReactiveNestedSampler, resume_from_similar_file
+from ultranest.integrator import ReactiveNestedSampler, warmstart_from_similar_file
 import ultranest.stepsampler
 import warnings
 from .priors import create_prior_function
+from .fluxes import get_distribution_with_fluxes, calc_band_fluxes
+from .frozencache import SubexpressionCache
+from .fastfold import ProfiledAmplitudeStatistic
 
 if 'MAKESPHINXDOC' not in os.environ:
 	import sherpa.astro.ui as ui
@@ -53,7 +55,8 @@ class BXASolver(object):
 	def __init__(
 		self, id=None, otherids=(), prior=None, parameters=None,
 		outputfiles_basename='chains/',
-		resume_from=None
+		resume_from=None, vectorized=False, stat_function=None,
+		amplitudes=None, amplitude_method='profile'
 	):
 		"""
 		Set up Bayesian analysis with specified parameters+transformations.
@@ -63,20 +66,42 @@ class BXASolver(object):
 		:param prior: prior function created with create_prior_function.
 		:param parameters: List of parameters to analyse.
 		:param outputfiles_basename: prefix for output filenames.
-		:param resume_from: prefix for output filenames of a previous run with similar posterior from which to resume
+		:param resume_from: prefix for output filenames of a previous run with similar posterior from which to resume.
+			The sampling is then warm-started from that posterior (see ultranest.integrator.warmstart_from_similar_file),
+			which adds an auxiliary parameter 'aux_logweight' to the sampled parameters.
+		:param vectorized: if True, log_likelihood and prior_transform receive
+			arrays of shape (N, ndim) and return N results. This allows
+			using the vectorized region and population step samplers of ultranest.
+		:param stat_function: function receiving an (N, ndim) array of parameter
+			values and returning N fit statistic values. By default, the
+			parameters are set one row at a time and the sherpa fit statistic
+			is computed. If amplitudes are given, this must be a
+			ProfiledAmplitudeStatistic (created by default).
+		:param amplitudes: List of amplitude parameters (such as normalisations of
+			additive components) which are not sampled, but removed analytically
+			from the Poisson likelihood (see ProfiledAmplitudeStatistic).
+			The source models must be linear in these parameters. Only datasets
+			with source models and without background models are supported
+			(see FastFoldedStatistic).
+		:param amplitude_method: 'profile' to use the best amplitudes for each point,
+			'laplace' to marginalise them with a Laplace approximation
+			(uniform priors within the parameter limits).
 
 		If prior is None, uniform priors are used on the passed parameters.
-		If parameters is also None, all thawed parameters are used.
+		If parameters is also None, all thawed parameters are used
+		(except for the amplitudes).
 		"""
 
 		self.id = id
 		self.otherids = otherids
 
 		self.fit = ui._session._get_fit(self.id, self.otherids)[1]
+		self.amplitudes = [] if amplitudes is None else list(amplitudes)
 		if parameters is None:
-			parameters = self.fit.model.thawedpars
+			parameters = [p for p in self.fit.model.thawedpars
+				if all(p is not a for a in self.amplitudes)]
 		if prior is None:
-			prior = create_prior_function(id=id, otherids=otherids, parameters=parameters)
+			prior = create_prior_function(parameters=parameters)
 
 		self.prior = prior
 		self.parameters = parameters
@@ -84,13 +109,21 @@ class BXASolver(object):
 		self.set_paramnames()
 		self.allowed_stats = (Cash, CStat)
 		self.ndims = len(parameters)
-		self.vectorized = False
+		self.vectorized = vectorized
+		if self.amplitudes and stat_function is not None and not isinstance(stat_function, ProfiledAmplitudeStatistic):
+			raise ValueError('amplitudes can only be combined with a ProfiledAmplitudeStatistic as stat_function')
+		if stat_function is None and self.amplitudes:
+			stat_function = ProfiledAmplitudeStatistic(
+				parameters, self.amplitudes, id=id, otherids=otherids, method=amplitude_method)
+		if stat_function is None:
+			stat_function = self.calc_stats
+		self.stat_function = stat_function
 
 		if resume_from is not None:
-			self.paramnames, self.log_likelihood, self.prior_transform, self.vectorized = resume_from_similar_file(
+			self.paramnames, self.log_likelihood, self.prior_transform, self.vectorized = warmstart_from_similar_file(
 				os.path.join(resume_from, 'chains', 'weighted_post_untransformed.txt'),
 				self.paramnames, loglike=self.log_likelihood, transform=self.prior_transform,
-				vectorized=False,
+				vectorized=self.vectorized,
 			)
 
 	def set_paramnames(self, paramnames=None):
@@ -105,35 +138,88 @@ class BXASolver(object):
 	def prior_transform(self, cube):
 		"""unit cube transformation.
 
+		In vectorized mode, *cube* has shape (N, ndim).
+
 		see https://johannesbuchner.github.io/UltraNest/priors.html#Dependent-priors
 		"""
 		params = cube.copy()
-		self.prior(params, self.ndims, self.ndims)
+		if params.ndim == 1 or getattr(self.prior, 'vectorized', False):
+			self.prior(params, self.ndims, self.ndims)
+		else:
+			for row in params:
+				self.prior(row, self.ndims, self.ndims)
 		return params
 
+	def set_parameter_values(self, values):
+		"""Set the analysed parameters to *values*, checking them once for NaNs."""
+		values = numpy.asarray(values, dtype=float)
+		if not numpy.isfinite(values).all():
+			i = numpy.where(~numpy.isfinite(values))[0][0]
+			raise ValueError('ERROR: parameter %d (%s) to be set to %f' % (i, self.parameters[i].fullname, values[i]))
+		for p, v in zip(self.parameters, values):
+			p.val = v
+
+	def calc_stats(self, points):
+		"""Compute the fit statistic for each row of *points*.
+
+		This is the default batched evaluation: the parameters
+		of each row are set and the sherpa fit statistic is computed.
+		"""
+		stats = numpy.empty(len(points))
+		for j, row in enumerate(points):
+			self.set_parameter_values(row)
+			stats[j] = self.fit.calc_stat()
+		return stats
+
 	def log_likelihood(self, cube):
-		""" returns -0.5 of the fit statistic."""
+		""" returns -0.5 of the fit statistic.
+
+		In vectorized mode, *cube* has shape (N, ndim) and N values are returned.
+		"""
+		points = numpy.asarray(cube, dtype=float).reshape((-1, self.ndims))
 		try:
-			for i, p in enumerate(self.parameters):
-				assert not isnan(cube[i]), 'ERROR: parameter %d (%s) to be set to %f' % (i, p.fullname, cube[i])
-				p.val = cube[i]
-				# print "%s: %f" % (p.fullname,p.val),
-			return -0.5 * self.fit.calc_stat()
+			logl = -0.5 * self.stat_function(points)
 		except Exception as e:
 			print('Exception in log_likelihood function: ', e)
+			j = 0
+			if len(points) > 1:
+				# find the first row of the batch that fails on its own
+				for k, row in enumerate(points):
+					try:
+						self.stat_function(row.reshape((1, -1)))
+					except Exception:
+						j = k
+						print('    Failing row %d of %d:' % (j, len(points)))
+						break
+				else:
+					print('    No row fails on its own; first row of %d:' % len(points))
 			for i, p in enumerate(self.parameters):
-				print('    Parameter %10s: %f --> %f [%f..%f]' % (p.fullname, p.val, cube[i], p.min, p.max))
+				print('    Parameter %10s: %f --> %f [%f..%f]' % (p.fullname, p.val, points[j,i], p.min, p.max))
 			raise e
+		if numpy.ndim(cube) == 1:
+			return logl[0]
+		return logl
 
 	def run(
 		self, sampler_kwargs={'resume': 'overwrite'}, run_kwargs={'Lepsilon': 0.1},
 		speed="safe", resume=None, n_live_points=None,
-		frac_remain=None, Lepsilon=0.1, evidence_tolerance=None
+		frac_remain=None, Lepsilon=0.1, evidence_tolerance=None,
+		cache_frozen=False, cache_components=False
 	):
 		"""Run nested sampling with ultranest.
 
 		:sampler_kwargs: arguments passed to ReactiveNestedSampler (see ultranest documentation)
 		:run_kwargs: arguments passed to ReactiveNestedSampler.run() (see ultranest documentation)
+		:param cache_frozen: during the run, compute sub-expressions of the source
+			models whose parameters are all frozen only once per energy grid
+			(see SubexpressionCache). Only used with the default stat_function.
+			This helps for expensive frozen components (such as table or
+			convolution models); for cheap ones, hashing the energy grid
+			on each call can cost more than it saves.
+		:param cache_components: also cache the output of each model component
+			by its own parameter values, so that a change of a normalisation or
+			another cheap component does not recompute expensive components.
+			See cache_report() for how often the cached outputs were reused.
 
 		The following arguments are also available directly for backward compatibility:
 
@@ -167,27 +253,42 @@ class BXASolver(object):
 			log_dir=self.outputfiles_basename,
 			vectorized=self.vectorized, **sampler_kwargs)
 
-		if speed == "safe":
-			pass
-		elif speed == "auto":
-			region_filter = run_kwargs.pop('region_filter', True)
-			self.sampler.run(max_ncalls=40000, **run_kwargs)
-
-			self.sampler.stepsampler = ultranest.stepsampler.SliceSampler(
-				nsteps=1000,
-				generate_direction=ultranest.stepsampler.generate_mixture_random_direction,
-				adaptive_nsteps='move-distance', region_filter=region_filter
-			)
-		else:
-			self.sampler.stepsampler = ultranest.stepsampler.SliceSampler(
-				generate_direction=ultranest.stepsampler.generate_mixture_random_direction,
-				nsteps=speed,
-				adaptive_nsteps=False,
-				region_filter=False)
-
-		self.sampler.run(**run_kwargs)
+		self.model_cache = None
+		if (cache_frozen or cache_components) and self.stat_function == self.calc_stats:
+			ids = ui._session._get_fit(self.id, self.otherids)[0]
+			self.model_cache = SubexpressionCache(ids, components=cache_components).apply()
+			# the fit object holds the models, so has to be recreated
+			self.fit = ui._session._get_fit(self.id, self.otherids)[1]
+		try:
+			if speed == "safe":
+				pass
+			elif speed == "auto":
+				region_filter = run_kwargs.pop('region_filter', True)
+				self.sampler.run(max_ncalls=40000, **run_kwargs)
+
+				self.sampler.stepsampler = ultranest.stepsampler.SliceSampler(
+					nsteps=1000,
+					generate_direction=ultranest.stepsampler.generate_mixture_random_direction,
+					adaptive_nsteps='move-distance', region_filter=region_filter
+				)
+			else:
+				self.sampler.stepsampler = ultranest.stepsampler.SliceSampler(
+					generate_direction=ultranest.stepsampler.generate_mixture_random_direction,
+					nsteps=speed,
+					adaptive_nsteps=False,
+					region_filter=False)
+
+			self.sampler.run(**run_kwargs)
+		finally:
+			if self.model_cache is not None:
+				self.model_cache.restore()
+				self.fit = ui._session._get_fit(self.id, self.otherids)[1]
 		self.sampler.print_results()
 		self.results = self.sampler.results
+		if self.amplitudes:
+			amplitudes, logvolumes = self.stat_function.sample_amplitudes(self.results['samples'][:, :self.ndims])
+			self.results['amplitude_samples'] = amplitudes
+			self.results['amplitude_logvolume'] = logvolumes
 		try:
 			self.sampler.plot()
 		except Exception as e:
@@ -198,13 +299,48 @@ class BXASolver(object):
 		self.set_best_fit()
 		return self.results
 
+	def cache_report(self):
+		"""Print how often the cached model outputs were reused in the last run
+		(see the cache_frozen and cache_components arguments of run).
+
+		Returns the list of entries, see SubexpressionCache.report.
+		"""
+		entries = [] if getattr(self, 'model_cache', None) is None else self.model_cache.report()
+		print('%-30s %10s %10s %7s  %s' % ('component', 'computed', 'reused', 'reuse', 'free parameters'))
+		for e in entries:
+			print('%-30s %10d %10d %6.1f%%  %s' % (
+				e['name'][:30], e['misses'], e['hits'], e['reuse'] * 100, ' '.join(e['parameters'])))
+		return entries
+
 	def set_best_fit(self):
 		"""Sets model to the best fit values."""
-		i = numpy.argmax(self.results['weighted_samples']['logl'])
-		for p, v in zip(self.parameters, self.results['weighted_samples']['points'][i, :]):
+		logl = self.results['weighted_samples']['logl']
+		points = self.results['weighted_samples']['points']
+		if points.shape[1] > self.ndims:
+			# warm-started run: remove the auxiliary weight
+			logl = logl - points[:, self.ndims]
+		i = numpy.argmax(logl)
+		for p, v in zip(self.parameters, points[i, :]):
 			p.val = v
+		if self.amplitudes:
+			best_amplitudes = self.stat_function.fit_amplitudes(points[i:i + 1, :self.ndims])[0]
+			for p, v in zip(self.amplitudes, best_amplitudes):
+				p.val = v
+
+	def get_posterior_samples(self):
+		"""Returns the analysed parameters and the equally weighted posterior samples.
 
-	def get_distribution_with_fluxes(self, elo=None, ehi=None):
+		If amplitudes were removed analytically, they are appended. For each
+		sample, they are drawn from the Laplace approximation of their
+		likelihood (see ProfiledAmplitudeStatistic.sample_amplitudes), so that
+		derived quantities such as fluxes include the amplitude uncertainty.
+		"""
+		samples = self.results['samples'][:, :self.ndims]
+		if not self.amplitudes:
+			return self.parameters, samples
+		return list(self.parameters) + self.amplitudes, numpy.hstack((samples, self.results['amplitude_samples']))
+
+	def get_distribution_with_fluxes(self, elo=None, ehi=None, nprocesses=1, chunksize=1000, resume=False):
 		"""Computes flux posterior samples.
 
 		Returns an array of equally weighted posterior samples (parameter values) with two
@@ -212,14 +348,55 @@ class BXASolver(object):
 
 		The values will be correctly distributed according to the
 		analysis run before.
-		"""
 
-		r = []
-		for row in self.results['samples']:
-			for p, v in zip(self.parameters, row):
-				p.val = v
-			r.append(
-				list(row) + [
-					ui._session.calc_photon_flux(lo=elo, hi=ehi, id=self.id),
-					ui._session.calc_energy_flux(lo=elo, hi=ehi, id=self.id)])
-		return numpy.array(r)
+		:param elo: lower end of the energy band
+		:param ehi: upper end of the energy band
+		:param nprocesses: number of worker processes to distribute the samples over.
+		:param chunksize: number of posterior samples computed per task.
+		:param resume: if True, finished chunks are stored in the output folder
+			and reused when called again, for example after an interruption.
+		"""
+		checkpoint_dir = None
+		if resume:
+			checkpoint_dir = os.path.join(self.outputfiles_basename, 'fluxes', '%s-%s' % (elo, ehi))
+		parameters, samples = self.get_posterior_samples()
+		return get_distribution_with_fluxes(
+			parameters, samples, id=self.id, elo=elo, ehi=ehi,
+			nprocesses=nprocesses, chunksize=chunksize, checkpoint_dir=checkpoint_dir)
+
+	def get_distribution_with_band_fluxes(
+		self, bands=[(0.5, 2), (2, 10)], restframe_bands=[], redshift=None,
+		model=None, cosmology=None, nbins=2000
+	):
+		"""Computes flux and luminosity posterior samples in several bands.
+
+		The unconvolved model is evaluated once per posterior sample on an
+		energy grid covering all bands, and photon and energy fluxes of
+		all bands are integrated from that single evaluation.
+
+		:param bands: list of (elo, ehi) observed-frame energy bands in keV.
+		:param restframe_bands: list of (elo, ehi) rest-frame energy bands in keV,
+			for which energy fluxes and luminosities are computed.
+		:param redshift: parameter (or value) giving the redshift.
+			If it is one of the analysed parameters, its posterior is used.
+		:param model: model to integrate (default: the source model of the
+			dataset). Pass for example the unabsorbed model for intrinsic fluxes.
+		:param cosmology: astropy cosmology for the luminosity distance
+			(default: flat LambdaCDM with H0=70, Omega_m=0.3).
+		:param nbins: number of bins of the energy grid.
+
+		Returns a dictionary with the posterior samples ('samples') and an array of
+		values for each band: 'photon_flux_<elo>-<ehi>' and 'energy_flux_<elo>-<ehi>',
+		and for rest-frame bands, 'restframe_energy_flux_<elo>-<ehi>' and
+		'luminosity_<elo>-<ehi>'. Fluxes are in phot/cm^2/s and erg/cm^2/s,
+		luminosities in erg/s.
+		"""
+		if model is None:
+			model = ui.get_source(self.id)
+		parameters, samples = self.get_posterior_samples()
+		results = calc_band_fluxes(
+			parameters, samples, model, bands,
+			restframe_bands=restframe_bands, redshift=redshift,
+			cosmology=cosmology, nbins=nbins)
+		results['samples'] = samples
+		return results
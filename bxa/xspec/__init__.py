@@ -13,7 +13,8 @@ from .sinning import binning
 from xspec import Plot
 import matplotlib.pyplot as plt
 from .priors import *
-from .solver import BXASolver, XSilence, create_prior_function
+from .solver import BXASolver, XSilence, create_prior_function, set_rebin
+from .pool import XspecPool
 
 
 def nested_run(
@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+BXA (Bayesian X-ray Analysis) for Xspec
+
+Copyright: Johannes Buchner (C) 2013-2025
+
+Prediction bands with bounded memory.
+"""
+
+import numpy
+import matplotlib.pyplot as plt
+
+
+class StreamingPredictionBand(object):
+	"""
+	Plot bands of model predictions, like ultranest.plot.PredictionBand,
+	without keeping all predictions in memory.
+
+	For each x and each requested quantile, the P² algorithm
+	(Jain & Chlamtac, 1985) keeps five markers which are updated as
+	predictions are added. Memory use is therefore independent of the
+	number of predictions.
+
+	:param x: Independent variable.
+	:param quantiles: quantiles to track. The defaults allow
+		shade(q=0.341), shade(q=0.495) and line().
+	:param shadeargs: default arguments for shade function.
+	:param lineargs: default arguments for line function.
+	"""
+
+	def __init__(self, x, quantiles=(0.005, 0.5 - 0.341, 0.5, 0.5 + 0.341, 0.995), shadeargs={}, lineargs={}):
+		self.x = x
+		self.quantiles = numpy.asarray(quantiles, dtype=float)
+		self.shadeargs = shadeargs
+		self.lineargs = lineargs
+		self.n_added = 0
+		p = self.quantiles.reshape((-1, 1, 1))
+		# marker position increments, shape (Q, 1, 5)
+		self.dn = numpy.concatenate([0 * p, p / 2, p, (1 + p) / 2, 1 + 0 * p], axis=2)
+		self.heights = None
+		self.first = []
+
+	def add(self, y):
+		"""Add a possible prediction *y*."""
+		y = numpy.asarray(y, dtype=float)
+		self.n_added += 1
+		if self.heights is None:
+			# collect the first five predictions to initialise the markers
+			self.first.append(y)
+			if len(self.first) == 5:
+				initial = numpy.sort(self.first, axis=0).transpose()
+				Q = len(self.quantiles)
+				self.heights = numpy.repeat(initial[None,:,:], Q, axis=0)
+				self.positions = numpy.repeat(numpy.arange(1., 6)[None,None,:], Q, axis=0) * numpy.ones_like(self.heights)
+				self.desired = 1 + 4 * self.dn * numpy.ones_like(self.heights)
+				self.first = None
+			return
+
+		q = self.heights
+		n = self.positions
+		# find cell k such that q[k] <= y < q[k+1], extending the extremes
+		k = (y[None,:,None] >= q[:,:,1:4]).sum(axis=2)
+		numpy.minimum(q[:,:,0], y[None,:], out=q[:,:,0])
+		numpy.maximum(q[:,:,4], y[None,:], out=q[:,:,4])
+		n += numpy.arange(5) > k[:,:,None]
+		self.desired += self.dn
+
+		# adjust the three middle markers
+		for i in 1, 2, 3:
+			d = self.desired[:,:,i] - n[:,:,i]
+			move = ((d >= 1) & (n[:,:,i+1] - n[:,:,i] > 1)) | ((d <= -1) & (n[:,:,i-1] - n[:,:,i] < -1))
+			if not move.any():
+				continue
+			d = numpy.where(d > 0, 1., -1.)
+			# piecewise-parabolic prediction
+			qp = q[:,:,i] + d / (n[:,:,i+1] - n[:,:,i-1]) * (
+				(n[:,:,i] - n[:,:,i-1] + d) * (q[:,:,i+1] - q[:,:,i]) / (n[:,:,i+1] - n[:,:,i]) +
+				(n[:,:,i+1] - n[:,:,i] - d) * (q[:,:,i] - q[:,:,i-1]) / (n[:,:,i] - n[:,:,i-1]))
+			# linear prediction, if the parabolic one is not monotonic
+			neighbour = numpy.where(d > 0, i + 1, i - 1)
+			qn = numpy.take_along_axis(q, neighbour[:,:,None], axis=2)[:,:,0]
+			nn = numpy.take_along_axis(n, neighbour[:,:,None], axis=2)[:,:,0]
+			ql = q[:,:,i] + d * (qn - q[:,:,i]) / (nn - n[:,:,i])
+			parabolic_ok = (q[:,:,i-1] < qp) & (qp < q[:,:,i+1])
+			q[:,:,i] = numpy.where(move, numpy.where(parabolic_ok, qp, ql), q[:,:,i])
+			n[:,:,i] += numpy.where(move, d, 0)
+
+	def set_shadeargs(self, **kwargs):
+		"""Set matplotlib style for shading."""
+		self.shadeargs = kwargs
+
+	def set_lineargs(self, **kwargs):
+		"""Set matplotlib style for line."""
+		self.lineargs = kwargs
+
+	def get_line(self, q=0.5):
+		"""Over prediction space x, get quantile *q*. Default is median."""
+		if not 0 <= q <= 1:
+			raise ValueError("quantile q must be between 0 and 1, not %s" % q)
+		assert self.n_added > 0, 'no predictions added'
+		i = numpy.argmin(numpy.abs(self.quantiles - q))
+		if not numpy.isclose(self.quantiles[i], q):
+			raise ValueError("quantile %s is not tracked, only %s" % (q, self.quantiles))
+		if self.heights is None:
+			return numpy.quantile(self.first, q, axis=0)
+		return self.heights[i,:,2]
+
+	def shade(self, q=0.341, ax=None, **kwargs):
+		"""Plot a shaded region between 0.5-q and 0.5+q, by default 1 sigma."""
+		if not 0 <= q <= 0.5:
+			raise ValueError("quantile distance from the median, q, must be between 0 and 0.5, not %s. For a 99%% quantile range, use q=0.48." % q)
+		shadeargs = dict(self.shadeargs)
+		shadeargs.update(kwargs)
+		lo = self.get_line(0.5 - q)
+		hi = self.get_line(0.5 + q)
+		if ax is None:
+			ax = plt
+		return ax.fill_between(self.x, lo, hi, **shadeargs)
+
+	def line(self, ax=None, **kwargs):
+		"""Plot the median curve."""
+		lineargs = dict(self.lineargs)
+		lineargs.update(kwargs)
+		mid = self.get_line(0.5)
+		if ax is None:
+			ax = plt
+		return ax.plot(self.x, mid, **lineargs)
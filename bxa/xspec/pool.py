@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+BXA (Bayesian X-ray Analysis) for Xspec
+
+Copyright: Johannes Buchner (C) 2013-2025
+
+Pool of worker processes, each with its own PyXspec session.
+"""
+
+import os
+import shutil
+import tempfile
+import multiprocessing
+import numpy
+
+from xspec import Xset, AllModels, AllData, Plot
+
+from .priors import apply_transform
+
+
+def parameter_locations(transformations):
+	"""Describe where each transformed parameter lives, as
+	(data group, model name, parameter index) tuples.
+
+	Unlike the model objects, these can be sent to other processes."""
+	locations = []
+	for t in transformations:
+		model = t['model']
+		group = (model.startParIndex - 1) // model.nParameters + 1
+		locations.append((group, model.name, t['index']))
+	return locations
+
+
+def transform_posterior(transformations, posterior):
+	"""Apply aftertransform to each column of posterior samples."""
+	values = numpy.empty(numpy.shape(posterior))
+	for i, t in enumerate(transformations):
+		values[:, i] = apply_transform(t, posterior[:, i], key='aftertransform')
+	return values
+
+
+_worker = {}
+
+
+def _init_worker(xcmfile, locations):
+	"""Pool initializer: reproduce data, ignored channels and models of the parent."""
+	Xset.chatter, Xset.logChatter = 0, 0
+	Xset.restore(xcmfile)
+	_worker['models'] = [AllModels(group, name) for group, name, index in locations]
+	_worker['indices'] = [index for group, name, index in locations]
+
+
+def _set_values(values):
+	pars = []
+	for model, index, v in zip(_worker['models'], _worker['indices'], values):
+		pars += [model, {index: v}]
+	AllModels.setPars(*pars)
+
+
+def _flux_task(args):
+	"""Compute energy and photon flux for each row of parameter values."""
+	values, erange, ispectrum, i_src = args
+	flux = []
+	for row in values:
+		_set_values(row)
+		AllModels.calcFlux(erange)
+		f = AllData(ispectrum).flux
+		flux.append([f[6 * i_src + 0], f[6 * i_src + 3]])
+	return numpy.array(flux)
+
+
+def _plot_task(args):
+	"""Compute plot arrays for each row of parameter values."""
+	from .solver import get_plot_content, apply_plot_settings
+	values, plottype, settings = args
+	apply_plot_settings(settings)
+	Plot.device = '/null'
+	maxncomp = 100 if Plot.add else 0
+	contents = []
+	for row in values:
+		_set_values(row)
+		content, maxncomp = get_plot_content(plottype, maxncomp)
+		contents.append(content)
+	return contents
+
+
+def _plot_model_task(args):
+	"""Compute the model array of one plot group for each row of parameter values."""
+	values, plottype, plotGroup, rebin = args
+	Plot.device = '/null'
+	Plot.xAxis = 'keV'
+	# workers inherit the plot rebinning at fork, so it is always set
+	if rebin is not None:
+		Plot.setRebin(minSig=rebin[0], maxBins=rebin[1], groupNum=-1)
+	else:
+		Plot.setRebin(minSig=0, maxBins=None, groupNum=None)
+	models = []
+	for row in values:
+		_set_values(row)
+		Plot(plottype)
+		models.append(Plot.model(plotGroup=plotGroup))
+	return numpy.array(models)
+
+
+class XspecPool(object):
+	"""
+	Pool of worker processes to evaluate many parameter vectors in parallel.
+
+	The current data (data groups, responses, backgrounds, ignored channels)
+	and models are saved to a xcm file, and each worker process restores
+	it in its own XSPEC session. Parameter vectors are then distributed
+	over the workers in chunks, and the results returned in order.
+
+	Workers are forked from the current process, so that scripts do
+	not need to be guarded with ``if __name__ == '__main__'``.
+	The pool captures the state at creation: create a new pool
+	if data or models change. Plot settings are passed with each plot
+	call; set the rebinning with set_rebin (not Plot.setRebin), so that
+	the workers can apply it.
+
+	Usage::
+
+		with XspecPool(solver.transformations, nprocesses=4) as pool:
+			flux = solver.create_flux_chain(spectrum, pool=pool)
+			solver.posterior_predictions_convolved(pool=pool)
+
+	:param transformations: parameter transformations, as passed to BXASolver
+	:param nprocesses: number of worker processes (default: number of CPUs)
+	:param chunksize: number of parameter vectors per task
+	"""
+	def __init__(self, transformations, nprocesses=None, chunksize=20):
+		self.transformations = transformations
+		self.chunksize = chunksize
+		self.tmpdir = tempfile.mkdtemp(prefix='bxa-pool')
+		xcmfile = os.path.join(self.tmpdir, 'state.xcm')
+		Xset.save(xcmfile, info='a')
+		context = multiprocessing.get_context('fork')
+		self.pool = context.Pool(
+			nprocesses, initializer=_init_worker,
+			initargs=(xcmfile, parameter_locations(transformations)))
+
+	def _chunks(self, posterior):
+		values = transform_posterior(self.transformations, numpy.asarray(posterior))
+		return [values[i:i + self.chunksize] for i in range(0, len(values), self.chunksize)]
+
+	def imap(self, task, posterior, *args):
+		"""Run *task* on chunks of the posterior, yielding the results of each chunk in order."""
+		return self.pool.imap(task, [(chunk,) + args for chunk in self._chunks(posterior)])
+
+	def flux(self, posterior, erange="2.0 10.0", ispectrum=1, i_src=0):
+		"""Energy flux (first column) and photon flux (second column) for each posterior sample."""
+		results = list(self.imap(_flux_task, posterior, erange, ispectrum, i_src))
+		if len(results) == 0:
+			return numpy.empty((0, 2))
+		return numpy.vstack(results)
+
+	def plot(self, posterior, plottype):
+		"""Yield the plot arrays (see get_plot_content) for each posterior sample.
+
+		The current Plot settings (see get_plot_settings), including the
+		rebinning set with set_rebin, are used by the workers."""
+		from .solver import get_plot_settings
+		settings = get_plot_settings()
+		for contents in self.imap(_plot_task, posterior, plottype, settings):
+			for content in contents:
+				yield content
+
+	def plot_model(self, posterior, plottype='data', plotGroup=1, rebin=None):
+		"""Yield the model array of plot group *plotGroup* for each posterior sample, in chunks
+		of shape (number of samples in chunk, number of bins).
+
+		:param rebin: (minSig, maxBins) passed to Plot.setRebin, or None for no rebinning.
+		"""
+		return self.imap(_plot_model_task, posterior, plottype, plotGroup, rebin)
+
+	def close(self):
+		"""Stop the worker processes."""
+		self.pool.close()
+		self.pool.join()
+		shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *args):
+		self.close()
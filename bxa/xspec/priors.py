@@ -10,6 +10,7 @@ Priors
 """
 
 from math import log10
+import numpy
 
 # priors
 def create_uniform_prior_for(model, par):
@@ -27,7 +28,7 @@ def create_uniform_prior_for(model, par):
 		raise UserWarning("in BXA v5, priors now use bottom/top soft parameter limits instead of hard parameter limits.")
 	def uniform_transform(x): return x * spread + low
 	return dict(model=model, index=par._Parameter__index, name=par.name, 
-		transform=uniform_transform, aftertransform=lambda x: x)
+		transform=uniform_transform, aftertransform=lambda x: x, vectorized=True)
 
 
 def create_jeffreys_prior_for(model, par):
@@ -54,7 +55,7 @@ def create_loguniform_prior_for(model, par):
 	def log_transform(x): return x * spread + low
 	def log_after_transform(x): return 10**x
 	return dict(model=model, index=par._Parameter__index, name='log(%s)' % par.name, 
-		transform=log_transform, aftertransform=log_after_transform)
+		transform=log_transform, aftertransform=log_after_transform, vectorized=True)
 
 
 def create_gaussian_prior_for(model, par, mean, std):
@@ -62,25 +63,40 @@ def create_gaussian_prior_for(model, par, mean, std):
 	Use for informed variables.
 	The Gaussian prior weights by a Gaussian in the parameter.
 	"""
-	import scipy.stats
+	from scipy.special import ndtri
 	pval, pdelta, pmin, pbottom, ptop, pmax = par.values
 	if pmin != pbottom or ptop != pmax:
 		raise UserWarning("in BXA v5, priors now use bottom/top soft parameter limits instead of hard parameter limits.")
-	rv = scipy.stats.norm(mean, std)
 	def gauss_transform(x): 
-		return max(pbottom, min(ptop, rv.ppf(x)))
+		return numpy.clip(ndtri(x) * std + mean, pbottom, ptop)
 	print('  gaussian prior for %s of %f +- %f' % (par.name, mean, std))
 	return dict(model=model, index=par._Parameter__index, name=par.name, 
-		transform=gauss_transform, aftertransform=lambda x: x)
+		transform=gauss_transform, aftertransform=lambda x: x, vectorized=True)
 
 
-def create_custom_prior_for(model, par, transform, aftertransform = lambda x: x):
+def create_custom_prior_for(model, par, transform, aftertransform = lambda x: x, vectorized=False):
 	"""
 	Pass your own prior weighting transformation
+
+	Set vectorized=True if transform and aftertransform accept
+	numpy arrays, so that whole columns can be transformed at once.
 	"""
 	print('  custom prior for %s' % (par.name))
 	return dict(model=model, index=par._Parameter__index, name=par.name, 
-		transform=transform, aftertransform=aftertransform)
+		transform=transform, aftertransform=aftertransform, vectorized=vectorized)
+
+
+def apply_transform(transformation, values, key='transform'):
+	"""
+	Apply the *key* function ('transform' or 'aftertransform') of
+	*transformation* to an array of values.
+
+	Vectorized transformations are applied in one call, others element-wise.
+	"""
+	f = transformation[key]
+	if transformation.get('vectorized', False):
+		return f(values)
+	return numpy.array([f(v) for v in values], dtype=float)
 
 
 def create_prior_function(transformations):
@@ -89,8 +105,8 @@ def create_prior_function(transformations):
 	"""
 
 	def prior(cube, ndim, nparams):
+		points = cube.reshape((-1, ndim))
 		for i, t in enumerate(transformations):
-			transform = t['transform']
-			cube[i] = transform(cube[i])
+			points[:, i] = apply_transform(t, points[:, i])
 
 	return prior
@@ -7,7 +7,7 @@ BXA (Bayesian X-ray Analysis) for Xspec
 Copyright: Johannes Buchner (C) 2013-2025
 
 """
-from ultranest.integrator import ReactiveNestedSampler, resume_from_similar_file
+from ultranest.integrator import ReactiveNestedSampler, warmstart_from_similar_file
 from ultranest.plot import PredictionBand
 import ultranest.stepsampler
 import os
@@ -15,9 +15,12 @@ from math import isnan, isinf
 import warnings
 import numpy
 import tempfile
+import hashlib
 
 from . import qq
+from .bands import StreamingPredictionBand
 from .sinning import binning
+from .priors import apply_transform
 
 from xspec import Xset, AllModels, Fit, Plot
 import xspec
@@ -43,20 +46,32 @@ def create_prior_function(transformations):
 	"""
 	Create a single prior transformation function from a list of
 	transformations for each parameter. This assumes the priors factorize.
+
+	The returned function accepts a single unit cube point or an
+	array of shape (N, ndim), and transforms whole columns at once.
 	"""
 
 	def prior(cube):
-		params = cube.copy()
+		params = numpy.array(cube, dtype=float)
+		points = params.reshape((-1, len(transformations)))
 		for i, t in enumerate(transformations):
-			transform = t['transform']
-			params[i] = transform(cube[i])
+			points[:, i] = apply_transform(t, points[:, i])
 		return params
 
+	prior.vectorized = True
 	return prior
 
 
-def store_chain(chainfilename, transformations, posterior, fit_statistic):
-	"""Writes a MCMC chain file in the same format as the Xspec chain command."""
+def store_chain(chainfilename, transformations, posterior, fit_statistic, chunksize=10000, sidecar=None):
+	"""Writes a MCMC chain file in the same format as the Xspec chain command.
+
+	The rows are transformed and written in blocks of *chunksize*, so
+	that the memory needed does not grow with the size of the posterior.
+
+	:param sidecar: if 'npy' or 'hdf5', the chain is also written to a
+		.npy file (structured array) or .hdf5 file (one dataset per column)
+		next to chainfilename, for fast memory-mapped reading.
+	"""
 	import astropy.io.fits as pyfits
 
 	group_index = 1
@@ -78,12 +93,12 @@ def store_chain(chainfilename, transformations, posterior, fit_statistic):
 			original_parname = AllModels(1)(t["index"]).name
 		names.append('%s__%d' % (original_parname, t['index'] + index_offsets.get(group_index, 0)))
 
+	order = numpy.argsort(indices)
 	columns = [pyfits.Column(
-		name=name, format='D', unit=AllModels(1)(transformations[i]["index"]).unit, array=t['aftertransform'](posterior[:, i]))
-		for i, name in enumerate(names)]
-	columns = list(numpy.array(columns)[numpy.argsort(indices)])
-
-	columns.append(pyfits.Column(name='FIT_STATISTIC', format='D', array=fit_statistic))
+		name=names[i], format='D', unit=AllModels(1)(transformations[i]["index"]).unit)
+		for i in order]
+	columns.append(pyfits.Column(name='FIT_STATISTIC', format='D'))
+	colnames = [names[i] for i in order] + ['FIT_STATISTIC']
 	table = pyfits.ColDefs(columns)
 	header = pyfits.Header()
 	header.add_comment("""Created by BXA (Bayesian X-ray spectal Analysis) for Xspec""")
@@ -91,8 +106,64 @@ def store_chain(chainfilename, transformations, posterior, fit_statistic):
 	header['TEMPR001'] = 1.
 	header['STROW001'] = 1
 	header['EXTNAME'] = 'CHAIN'
-	tbhdu = pyfits.BinTableHDU.from_columns(table, header=header)
-	tbhdu.writeto(chainfilename, overwrite=True)
+	tbhdu = pyfits.BinTableHDU.from_columns(table, header=header, nrows=0)
+	nrows = len(posterior)
+	tbhdu.header['NAXIS2'] = nrows
+
+	sidecar_file = None
+	sidecar_filename = os.path.splitext(chainfilename)[0] + '.' + str(sidecar)
+	if sidecar == 'npy':
+		sidecar_file = numpy.lib.format.open_memmap(
+			sidecar_filename, mode='w+', shape=(nrows,), dtype=[(name, 'f8') for name in colnames])
+	elif sidecar == 'hdf5':
+		import h5py
+		sidecar_file = h5py.File(sidecar_filename, 'w')
+		for name in colnames:
+			sidecar_file.create_dataset(name, shape=(nrows,), dtype='f8')
+	elif sidecar is not None:
+		raise ValueError('sidecar must be None, "npy" or "hdf5", not "%s"' % sidecar)
+
+	# write headers, then stream the table rows in big-endian blocks
+	with open(chainfilename, 'wb') as fout:
+		fout.write(pyfits.PrimaryHDU().header.tostring().encode('ascii'))
+		fout.write(tbhdu.header.tostring().encode('ascii'))
+		for start in range(0, nrows, chunksize):
+			block = numpy.empty((min(chunksize, nrows - start), len(colnames)), dtype='>f8')
+			for j, i in enumerate(order):
+				block[:, j] = apply_transform(transformations[i], posterior[start:start + chunksize, i], key='aftertransform')
+			block[:, -1] = fit_statistic[start:start + chunksize]
+			fout.write(block.tobytes())
+			if sidecar_file is not None:
+				for j, name in enumerate(colnames):
+					sidecar_file[name][start:start + len(block)] = block[:, j]
+		# pad to a multiple of the FITS block size
+		datasize = nrows * len(colnames) * 8
+		fout.write(b'\0' * (-datasize % 2880))
+	if sidecar == 'npy':
+		sidecar_file.flush()
+		del sidecar_file
+	elif sidecar == 'hdf5':
+		sidecar_file.close()
+
+
+def find_rows(points, rows):
+	"""
+	For each of *rows*, find the index of the identical row in *points*.
+
+	Rows are compared as raw bytes, by sorting and binary search,
+	so this takes O(N log N) time for N points.
+	"""
+	points = numpy.ascontiguousarray(points, dtype=float)
+	rows = numpy.ascontiguousarray(rows, dtype=float)
+	rowtype = numpy.dtype((numpy.void, points.dtype.itemsize * points.shape[1]))
+	keys = points.view(rowtype).ravel()
+	queries = rows.view(rowtype).ravel()
+	order = numpy.argsort(keys, kind='stable')
+	positions = numpy.searchsorted(keys[order], queries)
+	indices = order[numpy.minimum(positions, len(order) - 1)]
+	if not (keys[indices] == queries).all():
+		raise ValueError('some rows were not found among the points')
+	return indices
 
 
 def set_parameters(transformations, values):
@@ -148,6 +219,78 @@ def get_isrc(erange="2.0 10.0", ispectrum=1, isource=1):
 	else:
 		raise ValueError('Spectrum %s not loaded, have only: %s' % (ispectrum, loglines))
 
+# arguments of the calls to set_rebin, because PyXspec cannot report the plot rebinning
+_rebin_calls = []
+
+
+def set_rebin(**kwargs):
+	"""
+	Call Plot.setRebin(**kwargs) and remember the arguments.
+
+	Use this instead of Plot.setRebin, so that worker processes
+	(see XspecPool.plot) apply the same rebinning.
+	"""
+	Plot.setRebin(**kwargs)
+	if kwargs not in _rebin_calls:
+		_rebin_calls.append(kwargs)
+
+
+def get_plot_settings():
+	"""
+	Current Plot settings which affect the plot arrays, including the
+	rebinning set with set_rebin, as a dictionary.
+	"""
+	settings = dict(rebin=[dict(kwargs) for kwargs in _rebin_calls])
+	for key in 'xAxis', 'add', 'area', 'background', 'perHz', 'xLog', 'yLog':
+		settings[key] = getattr(Plot, key, None)
+	return settings
+
+
+def apply_plot_settings(settings):
+	"""Apply Plot settings returned by get_plot_settings (in another process)."""
+	for key, v in settings.items():
+		if key == 'rebin':
+			for kwargs in v:
+				Plot.setRebin(**kwargs)
+		elif v is not None:
+			setattr(Plot, key, v)
+
+
+def get_plot_content(plottype, maxncomp):
+	"""
+	Make the plot *plottype* for the current parameters and return
+	its arrays (x, xErr, data, model and additive components, as columns).
+
+	Also returns the number of additive components found plus one,
+	to be passed as maxncomp next time.
+	"""
+	Plot(plottype)
+	# get plot data
+	if plottype == 'model':
+		base_content = numpy.transpose([
+			Plot.x(), Plot.xErr(), Plot.model()])
+	elif Plot.background:
+		base_content = numpy.transpose([
+			Plot.x(), Plot.xErr(), Plot.y(), Plot.yErr(),
+			Plot.backgroundVals(), numpy.zeros_like(Plot.backgroundVals()),
+			Plot.model()])
+	else:
+		base_content = numpy.transpose([
+			Plot.x(), Plot.xErr(), Plot.y(), Plot.yErr(),
+			Plot.model()])
+	# get additive components, if there are any
+	comp = []
+	for i in range(1, maxncomp):
+		try:
+			comp.append(Plot.addComp(i))
+		except Exception:
+			print('The error "***XSPEC Error: Requested array does not exist for this plot." can be ignored.')
+			maxncomp = i
+			break
+	content = numpy.hstack((base_content, numpy.transpose(comp).reshape((len(base_content), -1))))
+	return content, maxncomp
+
+
 class BXASolver(object):
 	"""
 	Run the Bayesian analysis.
@@ -160,7 +303,9 @@ class BXASolver(object):
 	:param transformations: List of parameter transformation definitions
 	:param prior_function: set only if you want to specify a custom, non-separable prior
 	:param outputfiles_basename: prefix for output filenames.
-	:param resume_from: prefix for output filenames of a previous run with similar posterior from which to resume
+	:param resume_from: prefix for output filenames of a previous run with similar posterior from which to resume.
+		The sampling is then warm-started from that posterior (see ultranest.integrator.warmstart_from_similar_file),
+		which adds an auxiliary parameter 'aux_logweight' to the sampled parameters.
 
 	More information on the concept of prior transformations is available at
 	https://johannesbuchner.github.io/UltraNest/priors.html
@@ -190,7 +335,7 @@ class BXASolver(object):
 		self.outputfiles_basename = outputfiles_basename
 
 		if resume_from is not None:
-			self.paramnames, self.log_likelihood, self.prior_function, self.vectorized = resume_from_similar_file(
+			self.paramnames, self.log_likelihood, self.prior_function, self.vectorized = warmstart_from_similar_file(
 				os.path.join(resume_from, 'chains', 'weighted_post_untransformed.txt'),
 				self.paramnames, loglike=self.log_likelihood, transform=self.prior_function,
 				vectorized=False,
@@ -202,10 +347,21 @@ class BXASolver(object):
 		else:
 			self.paramnames = paramnames
 
+	def get_weighted_logl(self):
+		"""Log-likelihood of the weighted samples of the last run.
+
+		For warm-started runs, the auxiliary weight is removed."""
+		logl = self.results['weighted_samples']['logl']
+		points = self.results['weighted_samples']['points']
+		nparams = len(self.transformations)
+		if points.shape[1] > nparams:
+			logl = logl - points[:, nparams]
+		return logl
+
 	def set_best_fit(self):
 		"""Sets model to the best fit values."""
-		i = numpy.argmax(self.results['weighted_samples']['logl'])
-		params = self.results['weighted_samples']['points'][i, :]
+		i = numpy.argmax(self.get_weighted_logl())
+		params = self.results['weighted_samples']['points'][i, :len(self.transformations)]
 		set_parameters(transformations=self.transformations, values=params)
 
 	def log_likelihood(self, params):
@@ -220,12 +376,14 @@ class BXASolver(object):
 	def run(
 		self, sampler_kwargs={'resume': 'overwrite'}, run_kwargs={'Lepsilon': 0.1},
 		speed="safe", resume=None, n_live_points=None,
-		frac_remain=None, Lepsilon=0.1, evidence_tolerance=None
+		frac_remain=None, Lepsilon=0.1, evidence_tolerance=None,
+		chain_sidecar=None
 	):
 		"""Run nested sampling with ultranest.
 
 		:sampler_kwargs: arguments passed to ReactiveNestedSampler (see ultranest documentation)
 		:run_kwargs: arguments passed to ReactiveNestedSampler.run() (see ultranest documentation)
+		:param chain_sidecar: also write chain.fits as 'npy' or 'hdf5' file, for fast reading (see store_chain)
 
 		The following arguments are also available directly for backward compatibility:
 
@@ -288,13 +446,13 @@ class BXASolver(object):
 				traceback.print_exc()
 				warnings.warn("plotting failed.")
 
-			logls = [self.results['weighted_samples']['logl'][
-				numpy.where(self.results['weighted_samples']['points'] == sample)[0][0]]
-				for sample in self.results['samples']]
-			self.posterior = self.results['samples']
+			indices = find_rows(self.results['weighted_samples']['points'], self.results['samples'])
+			logls = self.get_weighted_logl()[indices]
+			# without the auxiliary parameter of warm-started runs
+			self.posterior = self.results['samples'][:, :len(self.transformations)]
 
 			chainfilename = '%schain.fits' % self.outputfiles_basename
-			store_chain(chainfilename, self.transformations, self.posterior, -2 * logls)
+			store_chain(chainfilename, self.transformations, self.posterior, -2 * logls, sidecar=chain_sidecar)
 			xspec.AllChains.clear()
 			xspec.AllChains += chainfilename
 
@@ -303,7 +461,7 @@ class BXASolver(object):
 
 		return self.results
 
-	def create_flux_chain(self, spectrum, erange="2.0 10.0", nsamples=None, i_src=0):
+	def create_flux_chain(self, spectrum, erange="2.0 10.0", nsamples=None, i_src=0, pool=None):
 		"""
 		For each posterior sample, computes the flux in the given energy range.
 
@@ -318,10 +476,14 @@ class BXASolver(object):
 		:param erange: argument to AllModels.calcFlux, energy range
 		:param nsamples: number of samples to consider (the default, None, means all)
 		:param i_src: index of source in case multiple sources are defined. Can be obtained with function bxa.solver.get_isrc. 
+		:param pool: XspecPool to distribute the samples over several processes (optional)
 		"""
 		# prefix = analyzer.outputfiles_basename
 		# modelnames = set([t['model'].name for t in transformations])
 
+		if pool is not None:
+			return pool.flux(self.posterior[:nsamples], erange=erange, ispectrum=spectrum.index, i_src=i_src)
+
 		with XSilence():
 			# plot models
 			flux = []
@@ -335,7 +497,8 @@ class BXASolver(object):
 			return numpy.array(flux)
 
 	def posterior_predictions_convolved(
-		self, component_names=None, plot_args=None, nsamples=400
+		self, component_names=None, plot_args=None, nsamples=400, pool=None,
+		cache=False, streaming=False, return_models=True
 	):
 		"""Plot convolved model posterior predictions.
 
@@ -344,6 +507,12 @@ class BXASolver(object):
 		:param component_names: labels to use. Set to 'ignore' to skip plotting a component
 		:param plot_args: matplotlib.pyplot.plot arguments for each component
 		:param nsamples: number of posterior samples to use (lower is faster)
+		:param pool: XspecPool to distribute the samples over several processes (optional)
+		:param cache: reuse the plot arrays stored by a previous call (see posterior_predictions_plot)
+		:param streaming: estimate the bands with StreamingPredictionBand,
+			which does not keep all model curves in memory.
+		:param return_models: if False, the model curves of all samples
+			are not collected and the 'models' entry is omitted from the results.
 		"""
 		# get data, binned to 10 counts
 		# overplot models
@@ -361,7 +530,7 @@ class BXASolver(object):
 		Plot.background = True
 		Plot.add = True
 
-		for content in self.posterior_predictions_plot(plottype='counts', nsamples=nsamples):
+		for content in self.posterior_predictions_plot(plottype='counts', nsamples=nsamples, pool=pool, cache=cache):
 			xmid = content[:, 0]
 			ndata_columns = 6 if Plot.background else 4
 			ncomponents = content.shape[1] - ndata_columns
@@ -371,11 +540,12 @@ class BXASolver(object):
 			for component in range(ncomponents):
 				y = content[:, ndata_columns + component]
 				if component >= len(bands):
-					bands.append(PredictionBand(xmid))
+					bands.append(StreamingPredictionBand(xmid) if streaming else PredictionBand(xmid))
 				bands[component].add(y)
 
 				model_contributions.append(y)
-			models.append(model_contributions)
+			if return_models:
+				models.append(model_contributions)
 
 		for band, label, component_plot_args in zip(bands, component_names, plot_args):
 			if label == 'ignore': continue
@@ -390,12 +560,13 @@ class BXASolver(object):
 			results = dict(list(zip('bins,width,data,error,background,backgrounderr'.split(','), data[0].transpose())))
 		else:
 			results = dict(list(zip('bins,width,data,error'.split(','), data[0].transpose())))
-		results['models'] = numpy.array(models)
+		if return_models:
+			results['models'] = numpy.array(models)
 		return results
 
 	def posterior_predictions_unconvolved(
 		self, component_names=None, plot_args=None, nsamples=400,
-		plottype='model',
+		plottype='model', pool=None, cache=False, streaming=False
 	):
 		"""
 		Plot unconvolved model posterior predictions.
@@ -404,6 +575,10 @@ class BXASolver(object):
 		:param plot_args: list of matplotlib.pyplot.plot arguments for each component, e.g. [dict(color='r'), dict(color='g'), dict(color='b')]
 		:param nsamples: number of posterior samples to use (lower is faster)
 		:param plottype: type of plot string, passed to `xspec.Plot()`
+		:param pool: XspecPool to distribute the samples over several processes (optional)
+		:param cache: reuse the plot arrays stored by a previous call (see posterior_predictions_plot)
+		:param streaming: estimate the bands with StreamingPredictionBand,
+			which does not keep all model curves in memory.
 		"""
 		if component_names is None:
 			component_names = ['model'] + ['component%d' for i in range(100-1)]
@@ -415,14 +590,14 @@ class BXASolver(object):
 		Plot.add = True
 		bands = []
 
-		for content in self.posterior_predictions_plot(plottype=plottype, nsamples=nsamples):
+		for content in self.posterior_predictions_plot(plottype=plottype, nsamples=nsamples, pool=pool, cache=cache):
 			xmid = content[:, 0]
 			ncomponents = content.shape[1] - 2
 			for component in range(ncomponents):
 				y = content[:, 2 + component]
 
 				if component >= len(bands):
-					bands.append(PredictionBand(xmid))
+					bands.append(StreamingPredictionBand(xmid) if streaming else PredictionBand(xmid))
 				bands[component].add(y)
 
 		for band, label, component_plot_args in zip(bands, component_names, plot_args):
@@ -434,46 +609,114 @@ class BXASolver(object):
 			band.shade(q=0.495, alpha=0.1, **shadeargs)
 			band.line(label=label, **lineargs)
 
-	def posterior_predictions_plot(self, plottype, nsamples=None):
+	def prediction_cache_key(self, posterior, plottype):
+		"""
+		Hash identifying the plot arrays of *posterior* for *plottype*, given
+		the loaded data, ignored channels, plot settings (see get_plot_settings;
+		rebinning is only included if set with set_rebin), model expressions
+		and frozen parameter values.
+		"""
+		h = hashlib.sha1()
+		h.update(numpy.ascontiguousarray(posterior, dtype=float).tobytes())
+		h.update(repr((plottype, sorted(get_plot_settings().items()))).encode())
+		for i in range(1, xspec.AllData.nSpectra + 1):
+			spectrum = xspec.AllData(i)
+			h.update(repr((spectrum.fileName, spectrum.dataGroup, spectrum.ignoredString())).encode())
+			for getter in (lambda s: s.background.fileName, lambda s: s.response.rmf, lambda s: s.response.arf):
+				try:
+					h.update(repr(getter(spectrum)).encode())
+				except Exception:
+					# not loaded
+					pass
+		models = []
+		for t in self.transformations:
+			if any(t['model'] is m for m in models):
+				continue
+			models.append(t['model'])
+			h.update(repr((t['model'].name, t['model'].expression, t['model'].startParIndex)).encode())
+			for j in range(1, t['model'].nParameters + 1):
+				par = t['model'](j)
+				if par.frozen or par.link != '':
+					h.update(repr((j, par.values[0], par.link)).encode())
+		return h.hexdigest()
+
+	def posterior_predictions_plot(self, plottype, nsamples=None, pool=None, cache=False):
 		"""
 		Internal Routine used by posterior_predictions_unconvolved, posterior_predictions_convolved
+
+		If cache is True, the plot arrays of all samples are stored in
+		the folder predictions/ of outputfiles_basename, under a hash of the
+		posterior, plot type, plot settings, data and model (see prediction_cache_key).
+		A later call with the same inputs loads them instead of recomputing.
+		Plot changes not covered by the hash (such as rebinning with
+		Plot.setRebin instead of set_rebin) are not detected, therefore
+		caching is off by default.
 		"""
 		# for plotting, we don't need so many points, and especially the
 		# points that barely made it into the analysis are not that interesting.
 		# so pick a random subset of at least nsamples points
 		posterior = self.posterior[:nsamples]
 
+		if cache:
+			cachefile = os.path.join(
+				self.outputfiles_basename, 'predictions',
+				self.prediction_cache_key(posterior, plottype) + '.npy')
+			if os.path.exists(cachefile):
+				for content in numpy.load(cachefile, mmap_mode='r'):
+					yield numpy.asarray(content)
+				return
+
+		if pool is not None:
+			contents = pool.plot(posterior, plottype)
+		else:
+			contents = self._plot_contents(posterior, plottype)
+
+		if not cache:
+			yield from contents
+			return
+
+		# the arrays are written to disk as they come in, rather than
+		# collected in memory; if the shape changes, no cache is written.
+		os.makedirs(os.path.dirname(cachefile), exist_ok=True)
+		partfile = cachefile + '.part.npy'
+		stored = None
+		try:
+			for k, content in enumerate(contents):
+				if k == 0:
+					stored = numpy.lib.format.open_memmap(
+						partfile, mode='w+', dtype=content.dtype,
+						shape=(len(posterior),) + content.shape)
+				if stored is not None:
+					if content.shape == stored.shape[1:]:
+						stored[k] = content
+					else:
+						stored = None
+						os.unlink(partfile)
+				yield content
+			if stored is not None:
+				stored.flush()
+				stored = None
+				os.replace(partfile, cachefile)
+		finally:
+			# if the caller stopped early, do not leave an incomplete file behind
+			stored = None
+			if hasattr(contents, 'close'):
+				contents.close()
+			if os.path.exists(partfile):
+				os.unlink(partfile)
+
+	def _plot_contents(self, posterior, plottype):
+		"""Yield the plot arrays for each row of posterior, computed in this process."""
 		with XSilence():
 			olddevice = Plot.device
 			Plot.device = '/null'
 
-			# plot models
-			maxncomp = 100 if Plot.add else 0
-			for k, row in enumerate(tqdm(posterior, disable=None)):
-				set_parameters(values=row, transformations=self.transformations)
-				Plot(plottype)
-				# get plot data
-				if plottype == 'model':
-					base_content = numpy.transpose([
-						Plot.x(), Plot.xErr(), Plot.model()])
-				elif Plot.background:
-					base_content = numpy.transpose([
-						Plot.x(), Plot.xErr(), Plot.y(), Plot.yErr(),
-						Plot.backgroundVals(), numpy.zeros_like(Plot.backgroundVals()),
-						Plot.model()])
-				else:
-					base_content = numpy.transpose([
-						Plot.x(), Plot.xErr(), Plot.y(), Plot.yErr(),
-						Plot.model()])
-				# get additive components, if there are any
-				comp = []
-				for i in range(1, maxncomp):
-					try:
-						comp.append(Plot.addComp(i))
-					except Exception:
-						print('The error "***XSPEC Error: Requested array does not exist for this plot." can be ignored.')
-						maxncomp = i
-						break	
-				content = numpy.hstack((base_content, numpy.transpose(comp).reshape((len(base_content), -1))))
-				yield content
-			Plot.device = olddevice
+			try:
+				# plot models
+				maxncomp = 100 if Plot.add else 0
+				for row in tqdm(posterior, disable=None):
+					set_parameters(values=row, transformations=self.transformations)
+					content, maxncomp = get_plot_content(plottype, maxncomp)
+					yield content
+			finally:
+				Plot.device = olddevice
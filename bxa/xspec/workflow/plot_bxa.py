@@ -9,15 +9,17 @@ import xspec
 import bxa.xspec as bxa
 import ultranest.plot as upl
 from .plot_xspec import PlotXspec
+from .scheduler import FitScheduler
 import numpy as np
 
 import os
+import re
 import json
-from natsort import natsorted 
 
 import matplotlib.pyplot as plt
 import matplotlib.gridspec as gridspec
 from matplotlib.ticker import MultipleLocator, AutoMinorLocator
+from matplotlib.collections import LineCollection
 plt.rc('font', family='serif')
 
 class PlotBXA(PlotXspec):
@@ -93,11 +95,19 @@ class PlotBXA(PlotXspec):
                              store_spec=False,
                              spec_prefix='',
                              savedir='fakeit_spectra',
-                             start_from_iter=0):
+                             start_from_iter=0,
+                             seed=None):
         '''
-        Use XSPEC's fakeit to create simulated spectra, using the
-        best-fit model from a BXA solver. This method requires the
-        active XSPEC model to match the model used in the solver.
+        Create simulated spectra, using the best-fit model from a BXA 
+        solver. This method requires the active XSPEC model to match the 
+        model used in the solver.
+        
+        Unless the spectra are stored or plot data are requested, the 
+        folded model counts are taken from XSPEC once and all Poisson 
+        realisations and their fit statistics are computed in memory (see 
+        _simulate_fit_statistics). Stored spectra, plot data (simulated 
+        counts per plot bin, as in Plot('counts')), and fit statistics 
+        other than cstat/cash use XSPEC's fakeit.
         
         Positional arguments
         solver           --- BXA solver; after solver.run() has completed
@@ -126,6 +136,8 @@ class PlotBXA(PlotXspec):
                              (for cases where it is useful to keep some of the faked 
                              spectra in place -- e.g. for reproducibility). This value
                              should be lower than nsample.
+        seed             --- int; seed for the random numbers of the in-memory
+                             simulation (default is None)
         
         Returns
         fitstat_best     --- float; fit statistic for best-fit model
@@ -149,6 +161,15 @@ class PlotBXA(PlotXspec):
         params = solver.results['posterior']['mean']
         bxa.solver.set_parameters(values=params,transformations=solver.transformations)
         fitstat_best = 0.5*xspec.Fit.statistic
+        # only fit statistics needed: simulate in memory
+        if (not store_spec and not return_plot_data
+            and xspec.Fit.statMethod.lower() in ('cstat','cash')):
+            spectra = range(1,len(orig_data)+1) if idsp is None else [idsp]
+            fitstat = self._simulate_fit_statistics(spectra,
+                                                    model_name=model_name,
+                                                    nsample=nsample-start_from_iter,
+                                                    seed=seed)
+            return fitstat_best, list(fitstat)
         # create fake spectra based on best-fit model
         fakeit_kw = []
         for ii,d in enumerate(orig_data):
@@ -190,8 +211,12 @@ class PlotBXA(PlotXspec):
             if store_spec:
                 for jj,fksetting in enumerate(fks):
                     fksetting.fileName = fnames[jj].format(ii+start_from_iter)
+                stored = {ii+start_from_iter: [fksetting.fileName for fksetting in fks]}
             # create fake spectra
             xspec.AllData.fakeit(nsim,fks)
+            # record them right away, so an interrupted run keeps its manifest
+            if store_spec:
+                self._update_spectra_manifest(savedir,spec_prefix,stored)
             for jj in range(nsim):
                 xspec.AllData(jj+1).ignore(fk_ign[jj])
             fitstat += [0.5*xspec.Fit.statistic]
@@ -220,6 +245,159 @@ class PlotBXA(PlotXspec):
         else:           
             return fitstat_best, fitstat
             
+    def _update_spectra_manifest(self,savedir,spec_prefix,stored):
+        '''
+        Record stored simulated spectra in savedir/manifest.json. The 
+        manifest maps spec_prefix and iteration to the list of files of
+        that iteration (one per simulated spectrum), so that several 
+        sets of simulations can share one directory.
+        
+        Positional arguments
+        savedir     --- string; directory containing the simulated spectra
+        spec_prefix --- string; prefix of the simulated spectra
+        stored      --- dict; iteration -> list of filenames
+        '''
+        manifest = self._load_spectra_manifest(savedir)
+        entries  = manifest.setdefault(spec_prefix,{})
+        for ii,files in stored.items():
+            entries[str(ii)] = files
+        # write the manifest atomically, so an interruption cannot corrupt it
+        fname = os.path.join(savedir,'manifest.json')
+        with open(fname+'.tmp','w') as f:
+            json.dump(manifest,f,indent=1)
+        os.replace(fname+'.tmp',fname)
+
+    def _load_spectra_manifest(self,savedir):
+        '''
+        Load the manifest of simulated spectra in savedir (see
+        _update_spectra_manifest). Returns an empty dict if there is none.
+        '''
+        fname = os.path.join(savedir,'manifest.json')
+        if not os.path.exists(fname):
+            return {}
+        with open(fname) as f:
+            return json.load(f)
+
+    def _get_folded_counts(self,ispectrum,model_name=''):
+        '''
+        Collect the expected counts of a loaded spectrum under the
+        current model, in its noticed channels.
+        
+        Positional arguments
+        ispectrum   --- int; index of the spectrum in XSPEC
+        
+        Keyword arguments
+        model_name  --- string; name of the model (default is '' -> unnamed model)
+        
+        Returns
+        counts      --- dict; 'source' (expected source counts), 'background'
+                        (background rate in the source region, or None), 
+                        'ts' and 'tb' (source and effective background exposure)
+        '''
+        spectrum = xspec.AllData(ispectrum)
+        noticed  = np.array(spectrum.noticed) - 1
+        def select(values):
+            # per-channel values may cover all channels or the noticed ones
+            values = np.atleast_1d(np.array(values,dtype=float))
+            if len(values) > len(noticed):
+                values = values[noticed]
+            return values
+        model = xspec.AllModels(spectrum.dataGroup,model_name)
+        ts = spectrum.exposure
+        counts = dict([('source', select(model.folded(ispectrum))*ts),
+                       ('background', None),
+                       ('ts', ts), ('tb', None)])
+        try:
+            bkg = spectrum.background
+        except Exception:
+            bkg = None
+        if bkg is not None:
+            # background counts are scaled to the source region
+            ratio = (select(spectrum.backScale)*select(spectrum.areaScale) /
+                     (select(bkg.backScale)*select(bkg.areaScale)))
+            counts['background'] = select(bkg.values)*ratio
+            # the simulated background has the exposure of the source,
+            # as set up for fakeit
+            counts['tb'] = ts/ratio
+        return counts
+
+    def _simulate_fit_statistics(self,spectra,
+                                 model_name=None,
+                                 nsample=100,
+                                 seed=None):
+        '''
+        Draw Poisson realisations of the loaded spectra under the 
+        current model and compute the fit statistic of each, without
+        writing files. For spectra with a background, the background 
+        is also simulated and the W-statistic is used, as XSPEC does
+        for cstat.
+        
+        Positional arguments
+        spectra        --- list of ints; indices of the spectra to simulate
+        
+        Keyword arguments
+        model_name     --- string; name of the model (default is None -> unnamed model)
+        nsample        --- int; number of realisations (default=100)
+        seed           --- int; seed for the random number generator
+        
+        Returns
+        fitstat        --- NumPy array; half the fit statistic (as 0.5*xspec.Fit.statistic)
+                           for each realisation, summed over the spectra
+        '''
+        if model_name is None:
+            model_name = ''
+        rng = np.random.default_rng(seed)
+        cash = xspec.Fit.statMethod.lower() == 'cash'
+        def xlogx(x):
+            return np.where(x>0,x*np.log(np.where(x>0,x,1)),0)
+        def log(x):
+            return np.log(np.maximum(x,1e-300))
+        fitstat = np.zeros(nsample)
+        for ispectrum in spectra:
+            c  = self._get_folded_counts(ispectrum,model_name=model_name)
+            mu = c['source']
+            if c['background'] is None:
+                S = rng.poisson(mu,size=(nsample,len(mu))).astype(float)
+                if cash:
+                    stat = mu - S*log(mu)
+                else:
+                    stat = mu - S + xlogx(S) - S*log(mu)
+            else:
+                ts, tb = c['ts'], c['tb']
+                S = rng.poisson(mu + ts*c['background'],size=(nsample,len(mu))).astype(float)
+                B = rng.poisson(tb*c['background'],size=(nsample,len(mu))).astype(float)
+                stat = self._wstat(S,B,mu/ts,ts,tb)
+            fitstat += stat.sum(axis=1)
+        return fitstat
+
+    def _wstat(self,S,B,y,ts,tb):
+        '''
+        W-statistic per channel (see the XSPEC manual, appendix B),
+        with the background rate profiled out. Half of the statistic 
+        is returned, to match 0.5*xspec.Fit.statistic.
+        
+        Positional arguments
+        S   --- NumPy array; source counts
+        B   --- NumPy array; background counts
+        y   --- NumPy array; model source rate
+        ts  --- float or array; source exposure
+        tb  --- float or array; effective background exposure
+        '''
+        def log(x):
+            return np.log(np.maximum(x,1e-300))
+        tt = ts+tb
+        d  = np.sqrt((tt*y-S-B)**2 + 4*tt*B*y)
+        f  = (S+B-tt*y+d)/(2*tt)
+        w  = (ts*y + tt*f - S*log(ts*y+ts*f) - B*log(tb*f)
+              - S*(1-log(S)) - B*(1-log(B)))
+        # special cases with zero counts
+        w0_src = ts*y - B*np.log(tb/tt)
+        w0_bkg = np.where(y < S/tt,
+                          -tb*y - S*np.log(ts/tt),
+                          ts*y + S*(log(S) - log(ts*y) - 1))
+        w = np.where(S==0, w0_src, np.where(B==0, w0_bkg, w))
+        return w
+
     def _activate_models_for_solver(self,solver,fmodel):
         '''
         For a given solver, (re-)activate the model it uses and point
@@ -665,7 +843,10 @@ class PlotBXA(PlotXspec):
                              rebinsig=None,
                              rebinbnum=10,
                              savename=None,
-                             print_values=False):
+                             print_values=False,
+                             nprocesses=1,
+                             savedata=None,
+                             return_instances=False):
         '''
         Plot the result of creating multiple instances of the same model
         with the parameters drawn from the specified priors. Can be used
@@ -691,6 +872,17 @@ class PlotBXA(PlotXspec):
                           (default is None)
         print_values  --- boolean; print the maximum and minimum values per parameter
                           (per model) to screen (default is False)
+        nprocesses    --- int; number of XSPEC worker processes computing the
+                          model instances (default is 1, no worker processes)
+        savedata      --- string; if set, the model instances of solver ii are 
+                          written to '{savedata}_{ii}.npy' while they are computed,
+                          and the parameter values to '{savedata}_{ii}_values.npy'
+        return_instances --- boolean; return the parameter values and model 
+                          instances (default is False)
+        
+        Returns (only if return_instances is True):
+        instances     --- list of (values,models) tuples, one per solver; see
+                          prior_predictive_instances
         '''
         # Check input data
         if type(solvers) is not list:
@@ -704,6 +896,7 @@ class PlotBXA(PlotXspec):
         # loop over the models and create a predictive plot for each
         if type(axs) is not np.ndarray:
             axs = (axs,)
+        instances = []
         for ii,s in enumerate(solvers):
             # re-activate model and point solver to new instance
             if models is not None:
@@ -712,13 +905,15 @@ class PlotBXA(PlotXspec):
             else:
                 mname = None
             # plot the model instances
-            self._instances_single_model(axs[ii],s,
-                                         nsample=nsample,
-                                         idsp=idsp,msize=5,
-                                         ymin=ymin,ymax=ymax,
-                                         rebinsig=rebinsig,
-                                         rebinbnum=rebinbnum,
-                                         print_values=print_values)
+            instances += [self._instances_single_model(axs[ii],s,
+                                                       nsample=nsample,
+                                                       idsp=idsp,msize=5,
+                                                       ymin=ymin,ymax=ymax,
+                                                       rebinsig=rebinsig,
+                                                       rebinbnum=rebinbnum,
+                                                       print_values=print_values,
+                                                       nprocesses=nprocesses,
+                                                       savedata=None if savedata is None else f'{savedata}_{ii}')]
             # label models
             m = s.transformations[0]['model'].expression
             fsize = np.minimum(24,int(28/len(m) * 24))
@@ -736,45 +931,127 @@ class PlotBXA(PlotXspec):
             plt.savefig(savename)
         else:
             plt.show()
-            
+        if return_instances:
+            return instances
+
+    def prior_predictive_instances(self,solver,
+                                   nsample=1000,
+                                   idsp=1,
+                                   rebinsig=None,
+                                   rebinbnum=10,
+                                   nprocesses=1,
+                                   savedata=None):
+        '''
+        Compute model instances (the folded model in the 'data' plot) with 
+        the parameters drawn from the priors of a solver. All unit-cube
+        draws are transformed at once; the model instances are computed by
+        a pool of XSPEC worker processes if nprocesses>1.
+        
+        Positional arguments:
+        solver        --- BXA solver
+        
+        Keyword arguments:
+        nsample       --- int; number of model instances to create
+        idsp          --- int; ID of spectrum (in plotGroup; default is 1)
+        rebinsig      --- int; minimum sigma per bin
+        rebinbnum     --- int; maximum number of bins to combine when
+                          rebinning using rebinsig
+        nprocesses    --- int; number of XSPEC worker processes (default is 1,
+                          no worker processes)
+        savedata      --- string; if set, the model instances are written to 
+                          '{savedata}.npy' as they are computed (instead of 
+                          being kept in memory), and the parameter values to 
+                          '{savedata}_values.npy'
+        
+        Returns:
+        values        --- NumPy array; parameter values (before aftertransform, 
+                          as the posterior of the solver), one row per instance
+        instances     --- NumPy array; model values, one row per instance. If 
+                          savedata is set, this is a read-only memory map
+        '''
+        # transform all draws from the unit cube at once
+        rnd = np.random.uniform(size=(nsample,len(solver.paramnames)))
+        if getattr(solver.prior_function,'vectorized',False):
+            values = solver.prior_function(rnd)
+        else:
+            # custom prior function, handling a single point only
+            values = np.array([solver.prior_function(u) for u in rnd])
+        if savedata is not None:
+            np.save(f'{savedata}_values.npy',values)
+        # the model instances are written into a preallocated array
+        instances = None
+        def store(k,m):
+            nonlocal instances
+            if instances is None:
+                shape = (nsample,len(m))
+                if savedata is None:
+                    instances = np.empty(shape)
+                else:
+                    instances = np.lib.format.open_memmap(f'{savedata}.npy',mode='w+',
+                                                          dtype=float,shape=shape)
+            instances[k] = m
+        xspec.Plot.xAxis = "keV"
+        if nprocesses > 1:
+            rebin = None if not rebinsig else (rebinsig,rebinbnum)
+            with bxa.XspecPool(solver.transformations,nprocesses=nprocesses) as pool:
+                k = 0
+                for chunk in pool.plot_model(values,plottype='data',
+                                             plotGroup=idsp,rebin=rebin):
+                    for m in chunk:
+                        store(k,m)
+                        k += 1
+        else:
+            if rebinsig:
+                xspec.Plot.setRebin(minSig=rebinsig,
+                                    maxBins=rebinbnum,
+                                    groupNum=-1)
+            else:
+                xspec.Plot.setRebin(minSig=0,maxBins=None,groupNum=None)
+            for k,row in enumerate(values):
+                bxa.solver.set_parameters(transformations=solver.transformations,
+                                          values=row)
+                xspec.Plot('data')
+                store(k,xspec.Plot.model(plotGroup=idsp))
+        if savedata is not None:
+            instances.flush()
+            del instances
+            instances = np.load(f'{savedata}.npy',mmap_mode='r')
+        return values, instances
+
     def _instances_single_model(self,ax,
                                 solver,nsample=100,
                                 idsp=1,msize=5,
                                 ymin=None,ymax=None,
                                 rebinsig=None,
                                 rebinbnum=10,
-                                print_values=False):
+                                print_values=False,
+                                nprocesses=1,
+                                savedata=None):
         '''
         Plot the prior predictions for a single model. This method works on 
         a single Matplotlib Axes.
+        
+        Returns the parameter values and model instances (see 
+        prior_predictive_instances).
         '''
-        # intitial setup for xspec
-        xspec.Plot.xAxis = "keV"
         # generate the xspec model data
-        mod_iter = []
-        values   = []
-        rnd      = np.random.uniform(size=(nsample,len(solver.paramnames)))
-        for ii in range(nsample):
-            values += [solver.prior_function(rnd[ii])]
-            bxa.solver.set_parameters(transformations=solver.transformations,
-                                      values=values[-1])
-            if rebinsig:
-                xspec.Plot.setRebin(minSig=rebinsig,
-                                    maxBins=rebinbnum,
-                                    groupNum=-1)
-            else:
-                xspec.Plot.setRebin(minSig=0,maxBins=None,groupNum=None)
-            xspec.Plot('data')
-            mod_iter += [xspec.Plot.model(plotGroup=idsp)]
+        values, mod_iter = self.prior_predictive_instances(solver,
+                                                           nsample=nsample,
+                                                           idsp=idsp,
+                                                           rebinsig=rebinsig,
+                                                           rebinbnum=rebinbnum,
+                                                           nprocesses=nprocesses,
+                                                           savedata=savedata)
         # get the xspec spectral data
         bins,rates,binw,ratese = self._get_xspec_data(model=False,
                                                       idsp=idsp,
                                                       rebinsig=rebinsig,
                                                       rebinbnum=rebinbnum)
-        # set up figure and plot data & models
-        for m in mod_iter:
-            x,y = self._extrapolate_model_log(bins,binw,m)
-            ax.plot(x,y,c='red',lw='2',alpha=0.55)
+        # set up figure and plot data & models, all instances at once
+        lines = [np.transpose(self._extrapolate_model_log(bins,binw,list(m)))
+                 for m in mod_iter]
+        ax.add_collection(LineCollection(lines,colors='red',lw=2,alpha=0.55))
+        ax.autoscale_view()
         self._make_spec_plot_main(ax,
                                      bins,rates,binw,ratese,
                                      ymin=ymin,ymax=ymax,
@@ -784,12 +1061,12 @@ class PlotBXA(PlotXspec):
         if print_values:
             print(f"Model: {solver.transformations[0]['model'].expression}")
             print('{:<10s}{:<10s}{:<10s}'.format('param','min','max'))
-            values = np.array(values)
             for ii in range(len(solver.paramnames)):
                 par  = solver.paramnames[ii]
                 minv = np.amin(values[:,ii])
                 maxv = np.amax(values[:,ii])
                 print('{:<10s}{:<10.4f}{:<10.4}'.format(par,minv,maxv)) 
+        return values, mod_iter
                 
     ############################
     #                          #
@@ -1379,6 +1656,7 @@ class PlotBXA(PlotXspec):
                             printq=False,
                             return_val=True,
                             ymax=None,
+                            nprocesses=1,
                             savename=None):
         '''
         Plot an overview of the posterior distribution of the fluxes for 
@@ -1411,6 +1689,8 @@ class PlotBXA(PlotXspec):
         return_val --- boolean; if True, the mean flux and uncertainties will be
                        returned as a list (default is False)        
         ymax       --- float; cut-off level for y-axis of plot
+        nprocesses --- int; number of XSPEC worker processes used to compute
+                       the fluxes (default is 1, no worker processes)
         savename   --- string; filename to store results (default is None)
         '''
         self._plot_posterior_statistic(solvers,
@@ -1422,6 +1702,7 @@ class PlotBXA(PlotXspec):
                                        q=quantile,
                                        printq=printq,
                                        ymax=ymax,
+                                       nprocesses=nprocesses,
                                        savename=savename)
         if return_val:
             return self.posterior_flux_unc
@@ -1472,6 +1753,7 @@ class PlotBXA(PlotXspec):
                                        q=0.341,
                                        printq=False,
                                        ymax=None,
+                                       nprocesses=1,
                                        savename=None):
         '''
         Plot an overview of a single statistic for a model, as specified
@@ -1508,6 +1790,8 @@ class PlotBXA(PlotXspec):
                        uncertainties, as specified by the quantiles, to screen
         ymax       --- float; upper limit for the y-axis of the plot(s)
                        (default is None -> automatic)
+        nprocesses --- int; number of XSPEC worker processes used to compute
+                       the fluxes (default is 1, no worker processes)
         savename   --- string; filename to store results (default is None)
         '''
         # Check input data
@@ -1542,7 +1826,8 @@ class PlotBXA(PlotXspec):
                                                   npost=nsample,
                                                   fluxrange=fluxrange,
                                                   color=colors[ii],
-                                                  q=q,printq=printq)
+                                                  q=q,printq=printq,
+                                                  nprocesses=nprocesses)
             elif stat == 'mc_likelihood':
                 # plot the log-L distributions based on MC data
                 self._posterior_mc_L_single_model(axs[ii],s,
@@ -1578,7 +1863,8 @@ class PlotBXA(PlotXspec):
                                      npost=-1,
                                      fluxrange=(0.2,2.0),
                                      color='k',
-                                     q=0.341,printq=False):
+                                     q=0.341,printq=False,
+                                     nprocesses=1):
         '''
         Plot an overview of the posterior distribution of the fluxes for 
         a single solver. This flux is calculated for the specified flux
@@ -1592,10 +1878,16 @@ class PlotBXA(PlotXspec):
         # calculate flux for each set of parameters in the solver's posteriors
         d = []
         frange = f'{fluxrange[0]:.2},{fluxrange[1]:.2f}'
-        for row in solver.posterior[:npost]:
-            bxa.solver.set_parameters(values=row,transformations=solver.transformations)
-            xspec.AllModels.calcFlux(frange)
-            d += [xspec.AllData(1).flux[0]*1e12] # in units of 10^-12 erg cm^-2 s^-1
+        if nprocesses > 1:
+            # distribute the posterior over XSPEC worker processes
+            with bxa.XspecPool(solver.transformations,nprocesses=nprocesses) as pool:
+                flux = pool.flux(solver.posterior[:npost],erange=frange,ispectrum=1)
+            d = list(flux[:,0]*1e12) # in units of 10^-12 erg cm^-2 s^-1
+        else:
+            for row in solver.posterior[:npost]:
+                bxa.solver.set_parameters(values=row,transformations=solver.transformations)
+                xspec.AllModels.calcFlux(frange)
+                d += [xspec.AllData(1).flux[0]*1e12] # in units of 10^-12 erg cm^-2 s^-1
         # plot the data
         c,b = np.histogram(d,bins=np.minimum(int(len(d)/10),20),
                            density=True)
@@ -1696,7 +1988,9 @@ class PlotBXA(PlotXspec):
 
     def _run_bxa_on_multiple_spectra(self,solver,model,filelist,
                                      bxa_dir,spec_prefix='',
-                                     npoints=200):
+                                     npoints=200,
+                                     nprocesses=1,
+                                     warmstart=False):
         '''
         Run a single solver for different datasets. The results will
         be stored in the bxa_dir directory, with a different subdirectory
@@ -1716,21 +2010,75 @@ class PlotBXA(PlotXspec):
         spec_prefix --- string; identifying prefix (e.g. the model name) for
                         files containing the simulated spectra
         npoints     --- int; number of live points to be used in BXA fitting
+        nprocesses  --- int; number of XSPEC worker processes fitting spectra
+                        in parallel (default=1)
+        warmstart   --- boolean; start each fit from the real-data posterior
+                        of the solver (see _run_bxa_jobs; default is False)
         
         Returns:
         logz        --- list of floats; the logZ values for the BXA runs
         '''
+        logz, = self._run_bxa_jobs([solver],[model],filelist,
+                                   bxa_dir=bxa_dir,
+                                   npoints=npoints,
+                                   nprocesses=nprocesses,
+                                   warmstart=warmstart)
+        return logz
+
+    def _run_bxa_jobs(self,solvers,models,filelist,
+                      bxa_dir,npoints=200,
+                      nprocesses=1,
+                      warmstart=False,
+                      max_ncalls='auto',
+                      frac_remain=None):
+        '''
+        Fit every set of spectra in filelist with every solver. The 
+        (spectra, model) fits are independent jobs, which are spread over
+        nprocesses XSPEC worker processes.
+        
+        Completed jobs are recorded in bxa_dir/manifest.json, so that an
+        interrupted run only fits the missing jobs when called again. The 
+        logZ values and the number of likelihood evaluations are appended
+        to bxa_dir/logz.txt as the jobs finish.
+        
+        The simulated spectra come from the same model as the real data,
+        so their posteriors are usually close to the posterior of the 
+        real data. With warmstart, each fit is started from the 
+        real-data posterior stored in the solver's outputfiles_basename
+        (see the resume_from argument of BXASolver), if that run exists.
+        Whether this saves likelihood evaluations depends on the problem; 
+        compare the logZ of a few warm-started fits with cold fits, as 
+        offsets of a few tenths can occur.
+        
+        Positional arguments:
+        solvers     --- list of BXA solvers
+        models      --- list of functions to activate the XSPEC model of each solver
+        filelist    --- nested list of filenames for X-ray spectra (see
+                        _run_bxa_on_multiple_spectra)
+        bxa_dir     --- string; name of the parent output directory
+                        for the BXA fitting results
+        
+        Keyword arguments:
+        npoints     --- int; number of live points to be used in BXA fitting
+        nprocesses  --- int; number of XSPEC worker processes (default=1)
+        warmstart   --- boolean; start each fit from the real-data posterior of
+                        the solver (default is False)
+        max_ncalls  --- int; maximum number of likelihood evaluations per fit. 
+                        'auto' (default) limits warm-started fits to twice the
+                        number used for the real data; None sets no limit
+        frac_remain --- float; stop each fit when the remaining posterior mass
+                        is below this fraction (default is None -> ultranest's
+                        default)
+        
+        Returns:
+        logz        --- list of lists of floats; the logZ values for each solver
+        '''
         # check directory exists to store multiple versions of BXA output
         if not os.path.exists(bxa_dir):
             os.makedirs(bxa_dir)
         # store current data format
         orig_data = self._find_loaded_data_format()    
-        # re-activate the model and point solver to new instance
-        mod,mname = model()
-        for t in solver.transformations:
-            t['model'] = mod
         # a) check format of currently loaded data (the faked spectra should match this)
-        solver_orig_basename = solver.outputfiles_basename
         nG = xspec.AllData.nGroups
         nS = xspec.AllData.nSpectra
         if nG==nS:
@@ -1740,9 +2088,22 @@ class PlotBXA(PlotXspec):
             # just load everything into a single group
             # (more complicated configurations are currently not possible)
             load_format = ['']*nS
-        # b) loop over the fake spectra
-        logz = []
-        for ii,flist in enumerate(filelist):
+        # b) define one job per model and set of fake spectra
+        mnames = []
+        for model in models:
+            _,mname = model()
+            mnames += [mname]
+        jobs = []
+        for kk,mname in enumerate(mnames):
+            for ii,flist in enumerate(filelist):
+                jobs += [(f'{mname}_{ii}', (kk, ii, list(flist)))]
+
+        def fit_spectra(kk, ii, flist):
+            solver = solvers[kk]
+            # re-activate the model and point solver to new instance
+            mod,mname = models[kk]()
+            for t in solver.transformations:
+                t['model'] = mod
             print('#######')
             print(f'Iteration {ii+1} for model {mname}; performing BXA fitting')
             print('#######')
@@ -1751,20 +2112,55 @@ class PlotBXA(PlotXspec):
             xspec.AllData(' '.join([f'{fmt} {f}' for fmt,f in zip(load_format,flist)]))
             for jj in range(len(flist)):
                 xspec.AllData(jj+1).ignore(orig_data[jj]['ign'])
-            # fit fake spectrum with BXA
-            solver.outputfiles_basename = os.path.join(bxa_dir,mname+f'_{ii}/')
-            solver.run(n_live_points=npoints,resume=True)
-            logz += [solver.results['logz']]
-        # c) restore solver's basename to original setting
-        solver.outputfiles_basename = solver_orig_basename
-        # d) restore original data
-        splist = [f"{d['dg']}:{d['ind']} {d['sp']}" for d in orig_data]
-        xspec.AllData(' '.join(splist))
-        xspec.AllData.notice('all')
-        xspec.AllData.ignore('bad')
-        for ii,d in enumerate(orig_data):
-            xspec.AllData(ii+1).ignore(d['ign'])
-        
+            # fit fake spectrum with BXA, starting from the real-data posterior
+            outputdir = os.path.join(bxa_dir,mname+f'_{ii}/')
+            realdir = solver.outputfiles_basename
+            run_kwargs = {'Lepsilon': 0.1}
+            if frac_remain is not None:
+                run_kwargs['frac_remain'] = frac_remain
+            # the prior of a warm-started solver has an extra dimension 
+            # (aux_logweight), so it is rebuilt from the transformations
+            solver_warmstarted = len(solver.paramnames) != len(solver.transformations)
+            if solver_warmstarted:
+                prior_function = bxa.create_prior_function(solver.transformations)
+            else:
+                prior_function = solver.prior_function
+            if (warmstart and not solver_warmstarted
+                and os.path.exists(os.path.join(realdir,'chains','weighted_post_untransformed.txt'))):
+                fit_solver = solver.__class__(solver.transformations,
+                                              prior_function=prior_function,
+                                              outputfiles_basename=outputdir,
+                                              resume_from=realdir)
+                if max_ncalls == 'auto':
+                    with open(os.path.join(realdir,'info','results.json')) as f:
+                        run_kwargs['max_ncalls'] = 2*json.load(f)['ncall']
+            else:
+                fit_solver = solver.__class__(solver.transformations,
+                                              prior_function=prior_function,
+                                              outputfiles_basename=outputdir)
+            if max_ncalls not in (None,'auto'):
+                run_kwargs['max_ncalls'] = max_ncalls
+            results = fit_solver.run(n_live_points=npoints,resume=True,
+                                     run_kwargs=run_kwargs)
+            return [float(results['logz']),int(results['ncall'])]
+
+        # c) run the jobs that are not completed yet
+        scheduler = FitScheduler(os.path.join(bxa_dir,'manifest.json'),
+                                 table=os.path.join(bxa_dir,'logz.txt'),
+                                 columns=('logz','ncall'),
+                                 nprocesses=nprocesses)
+        try:
+            results = scheduler.run(fit_spectra,jobs)
+        finally:
+            # d) restore original data and models
+            splist = [f"{d['dg']}:{d['ind']} {d['sp']}" for d in orig_data]
+            xspec.AllData(' '.join(splist))
+            xspec.AllData.notice('all')
+            xspec.AllData.ignore('bad')
+            for ii,d in enumerate(orig_data):
+                xspec.AllData(ii+1).ignore(d['ign'])
+        logz = [[results[f'{mname}_{ii}'][0] for ii in range(len(filelist))]
+                for mname in mnames]
         return logz
 
     def _run_bayes_factor_test_sim(self,solvers,models,
@@ -1772,7 +2168,10 @@ class PlotBXA(PlotXspec):
                                    fakeit_model=0,
                                    gen_new_spec=True,
                                    start_from_iter=0,
-                                   bxa_dir='test_sim',npoints=400):
+                                   bxa_dir='test_sim',npoints=400,
+                                   nprocesses=1,
+                                   warmstart=False,
+                                   max_ncalls='auto'):
         '''
         Create data for use in false positive tests (decision on Bayes factor)
         Simulated spectra will be created using the assumption that the first
@@ -1806,6 +2205,15 @@ class PlotBXA(PlotXspec):
                             reloaded)
         bxa_dir         --- string; name of the directory to store BXA fitting results
         npoints         --- int; number of live points to be used in BXA fitting
+        nprocesses      --- int; number of XSPEC worker processes fitting the
+                            simulated spectra in parallel. Completed fits are 
+                            recorded in bxa_dir, so an interrupted run resumes
+                            with the missing fits (default=1)
+        warmstart       --- boolean; start the fits of the simulated spectra from
+                            the real-data posterior of each solver (default=False)
+        max_ncalls      --- int; maximum number of likelihood evaluations per fit
+                            (default 'auto': twice the number needed for the real 
+                            data, for warm-started fits; see _run_bxa_jobs)
         '''
         if gen_new_spec:
             # re-activate first model and point solver to new instance
@@ -1820,28 +2228,34 @@ class PlotBXA(PlotXspec):
                                             spec_prefix=spec_prefix,
                                             savedir='fakeit_spectra')
         # create a list of all files in 'savedir', to be loaded for BXA fitting
-        filelist = []
         assert os.path.exists('fakeit_spectra'), 'No fake spectra exist, please set kwarg gen_new_spec=True'
-        dirlist = os.listdir('fakeit_spectra')
-        dirlist = natsorted(dirlist) # lexicographical sorting does not match the fakeit naming settings
+        stored = self._load_spectra_manifest('fakeit_spectra').get(spec_prefix,{})
+        if len(stored) == 0:
+            # spectra simulated without manifest: index the directory once,
+            # by iteration and spectrum number ({spec_prefix}_{ii}_..{jj}.pha;
+            # background files such as ..{jj}_bkg.pha do not match)
+            pattern = re.compile(re.escape(spec_prefix) + r'_(\d+)_.*?(\d+)\.pha$')
+            index = {}
+            for f in os.listdir('fakeit_spectra'):
+                match = pattern.match(f)
+                if match is not None:
+                    index[match.groups()] = os.path.join('fakeit_spectra',f)
+            stored = {}
+            for ii in range(nsample):
+                flist = [index.get((str(ii),str(jj))) for jj in range(xspec.AllData.nSpectra)]
+                if None not in flist:
+                    stored[str(ii)] = flist
+        filelist = []
         for ii in range(nsample):
-            flist = []
-            for jj in range(xspec.AllData.nSpectra):
-                for kk,f in enumerate(dirlist):
-                    if f.startswith(f'{spec_prefix}_{ii}') and f.endswith(f'{jj}.pha'):
-                        flist += [os.path.join('fakeit_spectra',dirlist.pop(kk))]
-                        break
-            filelist += [flist]
-        # generate logz values for the first model
-        logz1 = self._run_bxa_on_multiple_spectra(solvers[0],models[0],filelist,
-                     	                          bxa_dir=bxa_dir,
-                          	                      spec_prefix=spec_prefix,
-                              	                  npoints=npoints)
-        # generate logz values for the second model
-        logz2 = self._run_bxa_on_multiple_spectra(solvers[1],models[1],filelist,
-                 		                          bxa_dir=bxa_dir,
-                          	                      spec_prefix=spec_prefix,
-                               	                  npoints=npoints)
+            assert str(ii) in stored, f'No simulated spectra found for iteration {ii} with prefix {spec_prefix}'
+            filelist += [stored[str(ii)][:xspec.AllData.nSpectra]]
+        # generate logz values for both models, fitting the spectra in parallel
+        logz1,logz2 = self._run_bxa_jobs(solvers[:2],models[:2],filelist,
+                                         bxa_dir=bxa_dir,
+                                         npoints=npoints,
+                                         nprocesses=nprocesses,
+                                         warmstart=warmstart,
+                                         max_ncalls=max_ncalls)
 
         return logz1,logz2
 
@@ -1854,6 +2268,9 @@ class PlotBXA(PlotXspec):
                                  start_from_iter=0,
                                  mnames=None,
                                  npoints=400,
+                                 nprocesses=1,
+                                 warmstart=True,
+                                 max_ncalls='auto',
                                  quantile=0.99,
                                  color='g',
                                  filter_logz=True,
@@ -1864,17 +2281,25 @@ class PlotBXA(PlotXspec):
         factors for models 1 & 2 (log(Z2/Z1)), under the assumption
         that model 1 is correct.
         
-        For description of arguments, see _plot_bayes_factor_test()
+        By default, the fits of the simulated spectra are started from
+        the real-data posterior of each solver (warmstart=True) and 
+        limited to twice its number of likelihood evaluations 
+        (max_ncalls='auto'). For description of arguments, see 
+        _plot_bayes_factor_test()
         '''
         qval, logz = self._plot_bayes_factor_test(existing_data=existing_data,
                                                   datadir=datadir,
                                                   solvers=solvers,
+                                                  models=models,
                                                   nsample=nsample,
                                                   spec_prefix=spec_prefix,
                                                   gen_new_spec=gen_new_spec,
                                                   fakeit_model=0,
                                                   start_from_iter=start_from_iter,
                                                   npoints=npoints,
+                                                  nprocesses=nprocesses,
+                                                  warmstart=warmstart,
+                                                  max_ncalls=max_ncalls,
                                                   mnames=mnames,
                                                   quantile=quantile,
                                                   color=color,
@@ -1893,6 +2318,9 @@ class PlotBXA(PlotXspec):
                                  start_from_iter=0,
                                  mnames=None,
                                  npoints=400,
+                                 nprocesses=1,
+                                 warmstart=True,
+                                 max_ncalls='auto',
                                  quantile=0.99,
                                  color='r',
                                  filter_logz=True,
@@ -1903,11 +2331,16 @@ class PlotBXA(PlotXspec):
         factors for models 1 & 2 (log(Z2/Z1)), under the assumption
         that model 2 is correct.
         
-        For description of arguments, see _plot_bayes_factor_test()
+        By default, the fits of the simulated spectra are started from
+        the real-data posterior of each solver (warmstart=True) and 
+        limited to twice its number of likelihood evaluations 
+        (max_ncalls='auto'). For description of arguments, see 
+        _plot_bayes_factor_test()
         '''
         qval, logz = self._plot_bayes_factor_test(existing_data=existing_data,
                                                   datadir=datadir,
                                                   solvers=solvers,
+                                                  models=models,
                                                   nsample=nsample,
                                                   spec_prefix=spec_prefix,
                                                   fakeit_model=1,
@@ -1915,6 +2348,9 @@ class PlotBXA(PlotXspec):
                                                   start_from_iter=start_from_iter,
                                                   mnames=mnames,
                                                   npoints=npoints,
+                                                  nprocesses=nprocesses,
+                                                  warmstart=warmstart,
+                                                  max_ncalls=max_ncalls,
                                                   quantile=quantile,
                                                   color=color,
                                                   filter_logz=filter_logz,
@@ -1927,6 +2363,7 @@ class PlotBXA(PlotXspec):
                                 existing_data=False,
                                 datadir=None,
                                 solvers=None,
+                                models=None,
                                 nsample=None,
                                 spec_prefix=None,
                                 fakeit_model=0,
@@ -1934,6 +2371,9 @@ class PlotBXA(PlotXspec):
                                 start_from_iter=0,
                                 mnames=None,
                                 npoints=400,
+                                nprocesses=1,
+                                warmstart=True,
+                                max_ncalls='auto',
                                 quantile=0.99,
                                 color='g',
                                 filter_logz=True,
@@ -1946,6 +2386,9 @@ class PlotBXA(PlotXspec):
         datadir         --- string; directory where previous BXA fitting results are
                             stored
         solvers         --- list of two BXA solvers
+        models          --- list of two functions; the functions should contain the 
+                            XSPEC model definitions for each of the models (in 
+                            order matching the list of solvers)
         mnames          --- list of two strings; the names of the two models. These
                             should be the names used to store the models (typically,
                             this is the name of the model in XSpec). This only needs
@@ -1967,6 +2410,14 @@ class PlotBXA(PlotXspec):
                             fitted, after which _all_ BXA results in the datadir
                             will be loaded (i.e. including the pre-existing ones)
         npoints         --- int; number of live points to be used in BXA fitting
+        nprocesses      --- int; number of XSPEC worker processes fitting the
+                            simulated spectra in parallel (default=1)
+        warmstart       --- boolean; start the fits of the simulated spectra from
+                            the real-data posterior of each solver, if that run
+                            exists (default=True)
+        max_ncalls      --- int; maximum number of likelihood evaluations per fit
+                            (default 'auto': twice the number needed for the real 
+                            data, for warm-started fits; None for no limit)
         quantile        --- float; limit to mark in the plot, setting a cut-off
                             criterion for the distribution in log(z1/z2). Default
                             is 0.99
@@ -2027,7 +2478,10 @@ class PlotBXA(PlotXspec):
                                                           gen_new_spec=gen_new_spec,
                                                           start_from_iter=start_from_iter,
                                                           bxa_dir=datadir,
-                                                          npoints=npoints)
+                                                          npoints=npoints,
+                                                          nprocesses=nprocesses,
+                                                          warmstart=warmstart,
+                                                          max_ncalls=max_ncalls)
             m1name = solvers[0].transformations[0]['model'].name
             m2name = solvers[1].transformations[0]['model'].name
         # filter logz if necessary
@@ -0,0 +1,110 @@
+#
+# Resumable scheduling of BXA fits over a pool of XSPEC processes
+#
+
+import os
+import json
+import multiprocessing
+
+
+# job function of the current schedule; worker processes inherit it when forked
+_job_function = None
+
+
+def _run_job(job):
+    key, args = job
+    return key, _job_function(*args)
+
+
+class FitScheduler(object):
+    '''
+    Runs independent fitting jobs (e.g. one per simulated spectrum
+    and model) in a pool of worker processes, and keeps track of the
+    finished jobs.
+    ---
+    Workers are forked from the current process, so each has its own
+    copy of the XSPEC session (data, models and solvers). The job
+    function is therefore free to load data and define models.
+
+    Finished jobs are recorded in a JSON manifest, so that a
+    schedule that was interrupted only runs the missing jobs when
+    started again. The result of each job is also appended, as it
+    finishes, to a whitespace-separated results table.
+
+    Positional arguments:
+    manifest    --- string; filename of the JSON manifest
+
+    Keyword arguments:
+    table       --- string; filename of the results table (default is None
+                    -> no table)
+    columns     --- list of strings; names of the result columns in the
+                    table (the job key is always the first column)
+    nprocesses  --- int; number of worker processes (default=1 -> run the
+                    jobs in the current process)
+    '''
+
+    def __init__(self, manifest, table=None, columns=('logz',), nprocesses=1):
+        self.manifest = manifest
+        self.table = table
+        self.columns = list(columns)
+        self.nprocesses = nprocesses
+        self.done = {}
+        if os.path.exists(manifest):
+            with open(manifest) as f:
+                self.done = json.load(f)
+
+    def _record(self, key, signature, result):
+        '''
+        Store the result of a finished job in the manifest and the table.
+        '''
+        self.done[key] = dict(signature=signature, result=result)
+        # write the manifest atomically, so an interruption cannot corrupt it
+        with open(self.manifest + '.tmp', 'w') as f:
+            json.dump(self.done, f, indent=2)
+        os.replace(self.manifest + '.tmp', self.manifest)
+        if self.table is not None:
+            new_table = not os.path.exists(self.table)
+            with open(self.table, 'a') as f:
+                if new_table:
+                    f.write(' '.join(['job'] + self.columns) + '\n')
+                values = result if isinstance(result, (list, tuple)) else [result]
+                f.write(' '.join([key] + [repr(v) for v in values]) + '\n')
+
+    def run(self, function, jobs):
+        '''
+        Run the jobs that have not been completed yet.
+
+        Positional arguments:
+        function --- callable; called as function(*args) for each job. It
+                     must return a JSON-serialisable result.
+        jobs     --- list of (key, args) tuples; the key identifies the job
+                     in the manifest. A job is considered complete if the
+                     manifest contains its key with the same args.
+
+        Returns:
+        results  --- dict; job key -> result, for all jobs
+        '''
+        global _job_function
+        todo = []
+        for key, args in jobs:
+            entry = self.done.get(key)
+            if entry is None or entry['signature'] != json.loads(json.dumps(args)):
+                todo.append((key, args))
+        if len(todo) < len(jobs):
+            print(f'{len(jobs)-len(todo)} of {len(jobs)} jobs already completed')
+        signatures = {key: json.loads(json.dumps(args)) for key, args in todo}
+
+        _job_function = function
+        try:
+            if self.nprocesses > 1 and len(todo) > 1:
+                context = multiprocessing.get_context('fork')
+                with context.Pool(self.nprocesses) as pool:
+                    for key, result in pool.imap_unordered(_run_job, todo):
+                        self._record(key, signatures[key], result)
+            else:
+                for job in todo:
+                    key, result = _run_job(job)
+                    self._record(key, signatures[key], result)
+        finally:
+            _job_function = None
+        return {key: self.done[key]['result'] for key, args in jobs}
@@ -42,7 +42,7 @@ parameters = [
 	(p1.PhoIndex, 41),
 ]
 
-fastmodel = RebinnedModel(slowmodel=slowmodel, ebins=ebins, parameters=parameters, filename = 'testmodel.npz', modelname='fastmodel')
+fastmodel = RebinnedModel(slowmodel=slowmodel, ebins=ebins, parameters=parameters, filename = 'testmodel.npy', modelname='fastmodel')
 
 set_model(fastmodel)
 print(get_model())
@@ -0,0 +1,44 @@
+"""
+Benchmark of the chain log-likelihood look-up in BXASolver.run.
+
+Compares the previous look-up (numpy.where for each posterior sample)
+with bxa.xspec.solver.find_rows, for weighted points as produced by
+UltraNest, and checks that both find the same rows.
+
+Usage: python benchmark_find_rows.py [npoints] [ndim]
+"""
+import sys
+import time
+import numpy
+from bxa.xspec.solver import find_rows
+
+
+def find_rows_where(points, rows):
+	# previous implementation, before find_rows
+	return numpy.array([numpy.where(points == sample)[0][0] for sample in rows])
+
+
+npoints = int(sys.argv[1]) if len(sys.argv) > 1 else 10**6
+ndim = int(sys.argv[2]) if len(sys.argv) > 2 else 6
+rng = numpy.random.default_rng(1)
+
+points = rng.uniform(size=(npoints, ndim))
+# equally weighted samples are drawn from the weighted points
+samples = points[rng.integers(npoints, size=npoints // 10)]
+
+t0 = time.time()
+indices = find_rows(points, samples)
+t_new = time.time() - t0
+assert (points[indices] == samples).all()
+print('find_rows:   %d samples among %d points: %.3fs' % (len(samples), npoints, t_new))
+
+# the previous look-up is too slow for all samples, time a subset
+nsub = min(len(samples), 100)
+t0 = time.time()
+indices_old = find_rows_where(points, samples[:nsub])
+t_old = (time.time() - t0) * len(samples) / nsub
+print('numpy.where: %d samples among %d points: %.3fs (extrapolated from %d samples)' % (
+	len(samples), npoints, t_old, nsub))
+
+assert (indices_old == indices[:nsub]).all(), 'look-ups disagree'
+print('same rows found; speed-up: %.0fx' % (t_old / t_new))